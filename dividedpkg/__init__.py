@@ -2,17 +2,50 @@
 # Decryption credits to Ekey
 # Unpacking credits to aluigi & Ekey
 
-from dataclasses import dataclass
+import filecmp
+import mmap
+import os
+import shutil
+from array import array
+from collections.abc import Callable
+from contextlib import nullcontext
 from io import BytesIO
+from itertools import accumulate
 from pathlib import Path
+from threading import Lock, local
+from typing import BinaryIO
 
-from xorcrypt import xor_buffer, xor_parallel
+try:
+	from xorcrypt import rekey_parallel, xor_buffer, xor_parallel
+except ImportError:
+	# Extension isn't built, slower but works
+	try:
+		from .xornumpy import rekey_parallel, xor_buffer, xor_parallel
+	except ImportError as err:
+		raise ImportError("The xorcrypt extension isn't built, build it or install NumPy "
+			"for the slower fallback: pip install dividedpkg[numpy]") from err
+
+from . import stats
+from .cache import CompressionCache, EntryCache
+from .filters import Filter, Globs
+from .index import IndexCache, TableIndex
+from .policy import CompressionPolicy
+from .table import FileEntry, FileTable
 
 _KEY: bytes|None = None
 
 # Options
 CONSOLE = False
 CHECK_CONTENTS_BEFORE_BACKUP = True
+# Offset, length and format, length and version, file count, for the
+# "Reverge Package File" format version "1.1" every pkg is written as
+HEADER_SIZE = 4 + 8 + 20 + 8 + 3 + 8
+# Size of the pieces large entries are streamed in
+CHUNK_SIZE = 4 * 1024 * 1024
+# Default limit for each PKG's cache of entries it's read
+READ_CACHE_SIZE = 64 * 1024 * 1024
+# How .lz4 entries are compressed when nothing else is given
+COMPRESSION = CompressionPolicy()
 
 def get_key():
 	global _KEY
@@ -24,8 +57,8 @@ def get_key():
 def get_backup_name(original: Path):
 	return original.with_stem(original.stem + ".bak")
 
-def check_backup(original: Path):
-	backup = original.with_stem(original.stem + ".bak")
+def check_backup(original: Path, backup: Path|None = None):
+	backup = backup or get_backup_name(original)
 	if backup.exists():
 		if CONSOLE:
 			yn = input("Delete backup (y/n)? ")
@@ -35,6 +68,185 @@ def check_backup(original: Path):
 	return backup
 
 
+def get_undo_name(original: Path):
+	return original.with_name(original.name + ".undo")
+
+UNDO_MAGIC = b"DPKU"
+# Magic, original length, then size and mtime of the file it undoes
+UNDO_HEADER_SIZE = 4 + 8 + 8 + 8
+
+def _undo_header(undo: Path, original: Path):
+	"""
+	Header of undo if it exists and is for original as it is now.
+	"""
+	try:
+		with undo.open("rb") as f:
+			header = f.read(UNDO_HEADER_SIZE)
+	except FileNotFoundError:
+		return None
+	st = original.stat()
+	if (
+		len(header) == UNDO_HEADER_SIZE and header[:4] == UNDO_MAGIC
+		and header[12:] == st.st_size.to_bytes(8, "big") + st.st_mtime_ns.to_bytes(8, "big")
+	):
+		return header
+	return None
+
+def undo_in_place(fn: str|Path):
+	"""
+	Put back what in-place replaces overwrote in fn, from the undo file
+	they left next to it, which is then removed.
+	"""
+	fn = Path(fn)
+	undo = get_undo_name(fn)
+	header = _undo_header(undo, fn)
+	if not header:
+		raise ValueError(f"{undo} is missing or {fn} changed since it was written")
+	data = memoryview(undo.read_bytes())
+	records = list[tuple[int, memoryview]]()
+	pos = UNDO_HEADER_SIZE
+	while pos < len(data):
+		offset = int.from_bytes(data[pos:pos + 8], "big")
+		size = int.from_bytes(data[pos + 8:pos + 16], "big")
+		records.append((offset, data[pos + 16:pos + 16 + size]))
+		pos += 16 + size
+	with fn.open("r+b") as f:
+		# Newest first, so the oldest contents are what's left
+		for offset, chunk in reversed(records):
+			f.seek(offset)
+			f.write(chunk)
+		# Last, older records may reach past what later imports shrank it to
+		f.truncate(int.from_bytes(header[4:12], "big"))
+	undo.unlink()
+
+
+class ScratchBuffer:
+	"""
+	Grow-only buffer handed out in slices, so reading many entries in a row
+	only allocates as much as the largest of them.
+	"""
+	def __init__(self):
+		self.data = bytearray()
+
+	def view(self, size: int):
+		if len(self.data) < size:
+			# Replace rather than resize, views of the old one may still be alive
+			self.data = bytearray(size)
+		return memoryview(self.data)[:size]
+
+
+class CryptWriter:
+	"""
+	File-like wrapper that encrypts everything written through it for the
+	archive position it lands at. Without a key it just passes data through.
+	"""
+	def __init__(self, f: BinaryIO, offset: int, key: bytes|None, name="",
+		buffer: ScratchBuffer|None = None,
+	):
+		self.f = f
+		self.offset = offset
+		self.key = key
+		self.name = name
+		self.written = 0
+		# Encrypted copies of what's written, up to CHUNK_SIZE at a time
+		self.buffer = buffer or ScratchBuffer()
+		# Time spent in here when stats are on
+		self.busy = 0.0
+
+	def write(self, data):
+		data = memoryview(data).cast("B")
+		if not self.key:
+			self._put(data)
+			return len(data)
+		for pos in range(0, len(data), CHUNK_SIZE):
+			chunk = data[pos:pos + CHUNK_SIZE]
+			out = self.buffer.view(len(chunk))
+			out[:] = chunk
+			t = stats.clock()
+			xor_parallel(out, self.key, self.offset + self.written)
+			self.busy += stats.emit("xor", self.name, t, len(out))
+			self._put(out)
+		return len(data)
+
+	def _put(self, data: memoryview):
+		t = stats.clock()
+		self.f.write(data)
+		self.busy += stats.emit("write", self.name, t, len(data))
+		self.written += len(data)
+
+
+def copy_range(fin: BinaryIO, fout: BinaryIO, src_offset: int, size: int):
+	"""
+	Copy size bytes from src_offset in fin to the current position of fout
+	without them passing through Python, where the OS can do that (Linux's
+	copy_file_range, sendfile elsewhere). Returns False if it can't.
+	"""
+	copy = getattr(os, "copy_file_range", None)
+	if not copy and not hasattr(os, "sendfile"):
+		return False
+	fout.flush()
+	dst = fout.tell()
+	done = 0
+	try:
+		while done < size:
+			if copy:
+				n = copy(fin.fileno(), fout.fileno(), size - done, src_offset + done, dst + done)
+			else:
+				n = os.sendfile(fout.fileno(), fin.fileno(), src_offset + done, size - done)
+			if not n:
+				raise EOFError(f"{fin.name} ended {size - done} bytes early")
+			done += n
+	except OSError:
+		# Not supported between these files, nothing's been written yet
+		if done:
+			raise
+		return False
+	fout.seek(dst + size)
+	return True
+
+
+def copy_data(fin: BinaryIO, fout: BinaryIO, src_offset: int, dst_offset: int,
+	size: int, key: bytes|None, dst_key: bytes|None, name="",
+	buffer: ScratchBuffer|None = None,
+):
+	"""
+	Copy size bytes of archive data from src_offset in fin to the current
+	position of fout, which will be dst_offset in the new archive. The
+	source is encrypted with key and the copy with dst_key (None for plain
+	data). Data that stays as it is gets copied by the OS where possible,
+	otherwise it's re-keyed, decrypted or encrypted in a single pass.
+	"""
+	if key == dst_key and (not key or src_offset == dst_offset):
+		t = stats.clock()
+		if copy_range(fin, fout, src_offset, size):
+			stats.emit("copy", name, t, size)
+			return
+	buffer = buffer or ScratchBuffer()
+	fin.seek(src_offset)
+	done = 0
+	while done < size:
+		chunk = buffer.view(min(size - done, CHUNK_SIZE))
+		t = stats.clock()
+		n = fin.readinto(chunk)
+		stats.emit("read", name, t, n)
+		if not n:
+			raise EOFError(f"{fin.name} ended {size - done} bytes early")
+		chunk = chunk[:n]
+		if key != dst_key or key and src_offset != dst_offset:
+			t = stats.clock()
+			if key and dst_key:
+				rekey_parallel(chunk, key, src_offset + done, dst_offset + done)
+			elif key:
+				xor_parallel(chunk, key, src_offset + done)
+			else:
+				xor_parallel(chunk, dst_key, dst_offset + done)
+			stats.emit("xor", name, t, n)
+		t = stats.clock()
+		fout.write(chunk)
+		stats.emit("write", name, t, n)
+		done += n
+
+
 class PKG:
 	# Header components
 	format: str = "Reverge Package File"
@@ -46,11 +258,93 @@ class PKG:
 	backed_up = False
 	encrypted: bool|None = None
 
-	def __init__(self):
-		self.files = dict[str, FileEntry]()
+	# Memory map of filename, opened on first access
+	_map: mmap.mmap|None = None
+	_view: memoryview|None = None
+
+	def __init__(self, cache: EntryCache|None = None):
+		self.files = FileTable()
+		# Contents returned by read, kept apart from the table. May be shared
+		# between PKGs since keys include the archive's filename.
+		self.cache = EntryCache(READ_CACHE_SIZE) if cache is None else cache
+		self._map_lock = Lock()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *_):
+		self.close()
+
+	def mapped(self):
+		"""
+		Whole archive as a read-only memoryview, backed by mmap.
+		"""
+		with self._map_lock:
+			if self._view is None:
+				with self.filename.open("rb") as f:
+					self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				self._view = memoryview(self._map)
+			return self._view
+
+	def close(self):
+		"""
+		Unmap the archive. Views handed out by view() must not be used after this.
+		"""
+		if self._view is None:
+			return
+		self._view.release()
+		try:
+			self._map.close()
+		except BufferError:
+			# Views still exported, it'll be unmapped once they're collected
+			pass
+		self._map = self._view = None
+
+	def view(self, fn: str):
+		"""
+		Raw bytes of an entry as stored in the archive (still encrypted if it is).
+		"""
+		if fn not in self.files:
+			raise KeyError(f"{fn} not in file list")
+		entry = self.files[fn]
+		return self.mapped()[entry.offset:entry.offset + entry.size]
+
+	def decrypt(self, fn: str, buffer: ScratchBuffer|None = None):
+		"""
+		Decrypted bytes of an entry as a memoryview. When buffer is given the
+		result lives in it and is only valid until the buffer is reused.
+		Unencrypted archives return a view of the map directly.
+		"""
+		src = self.view(fn)
+		if not self.encrypted:
+			return src
+		entry = self.files[fn]
+		dst = buffer.view(entry.size) if buffer else memoryview(bytearray(entry.size))
+		t = stats.clock()
+		dst[:] = src
+		src.release()
+		stats.emit("read", fn, t, entry.size)
+		t = stats.clock()
+		xor_parallel(dst, get_key(), entry.offset)
+		stats.emit("xor", fn, t, entry.size)
+		return dst
 
 	@classmethod
-	def load(cls, fn: str|Path, encrypted: bool|None = None):
+	def load(cls, fn: str|Path, encrypted: bool|None = None,
+		index: IndexCache|None = None,
+	):
+		"""
+		Read a pkg's file table. With an index, a table saved from an earlier
+		load is used if the file hasn't changed since, otherwise it's saved.
+		"""
+		t = stats.clock()
+		if index:
+			table = index.get(fn)
+			if table and encrypted in (None, table.encrypted):
+				ret = cls.from_index(fn, table)
+				stats.emit("load", str(fn), t, 0)
+				return ret
+
 		f = open(fn, "rb")
 		ret = cls()
 		ret.filename = Path(fn)
@@ -78,58 +372,118 @@ class PKG:
 		ret.version = header.read(version_sz).decode("ascii")
 		ret.count = int.from_bytes(header.read(8))
 
-		# Read file entries
+		# Read file entries straight into columns
+		names = list[str]()
+		sizes = array("Q")
+		dummies = array("I")
+		pos = header.tell()
 		for _ in range(ret.count):
-			fn_sz = int.from_bytes(header.read(8))
-			fn = header.read(fn_sz).decode("ascii")
-			sz = int.from_bytes(header.read(8))
-			dummy = int.from_bytes(header.read(4))
-			ret.files[fn] = FileEntry(fn, sz, dummy, offset)
-			offset += sz
+			fn_sz = int.from_bytes(header_b[pos:pos + 8])
+			pos += 8
+			names.append(header_b[pos:pos + fn_sz].decode("ascii"))
+			pos += fn_sz
+			sizes.append(int.from_bytes(header_b[pos:pos + 8]))
+			dummies.append(int.from_bytes(header_b[pos + 8:pos + 12]))
+			pos += 12
+		# Data is laid out in table order
+		offsets = array("Q", accumulate(sizes, initial=offset))
+		offsets.pop()
+		ret.files = FileTable.from_columns(names, sizes, dummies, offsets)
 		f.close()
+
+		if index:
+			index.put(ret.filename, ret.to_index())
+		stats.emit("load", str(fn), t, offset)
 		return ret
 
+	@classmethod
+	def from_index(cls, fn: str|Path, table: TableIndex):
+		ret = cls()
+		ret.filename = Path(fn)
+		ret.encrypted = table.encrypted
+		ret.format = table.format
+		ret.version = table.version
+		ret.count = len(table.sizes)
+		ret.files = FileTable.from_blob(table.names_blob, table.name_starts, table.sizes,
+			table.dummies, table.offsets)
+		return ret
+
+	def to_index(self):
+		return TableIndex(self.format, self.version, bool(self.encrypted),
+			bytearray(self.files.names_blob),
+			array("Q", self.files.name_starts),
+			array("Q", self.files.sizes),
+			array("I", self.files.dummies),
+			array("Q", self.files.offsets),
+		)
+
 	@classmethod
 	def create(cls, outdir: str|Path, *,
 		encrypt=True, file_list: list[str] = [],
 		include: list[str] = [], exclude: list[str] = [],
 		compress_include: list[str] = [],
-		prefer_compressed=False,
+		prefer_compressed=False, jobs=1, cache: CompressionCache|None = None,
+		policy: CompressionPolicy|None = None, filter: Filter|None = None,
+		defer=True,
 	):
+		"""
+		Build a pkg from the files under outdir, those in file_list or else
+		those passing filter (made from include and exclude if not given).
+		outdir is scanned on jobs threads (0 for one per CPU). Compressing
+		is left to write, which keeps only so much of it in memory, so pass
+		policy and cache to write. Only without defer are files to compress
+		compressed up front following policy, on as many threads, reusing
+		earlier results from cache when given, and all of that is held by
+		the entries until they're written.
+		"""
+		if defer and (cache is not None or policy is not None):
+			raise ValueError("cache and policy only apply without defer, pass them to write")
 		outdir = Path(outdir)
+		policy = policy or COMPRESSION
+		filter = filter or Filter(include, exclude)
+		to_compress_globs = Globs(compress_include)
+		listed = set(file_list)
 		ret = cls()
 		ret.encrypted = encrypt
 		ret.format = "Reverge Package File"
 		ret.version = "1.1"
-		# Offset, length and format, length and version, file count
-		offset = 4 + 8 + 20 + 8 + 3 + 8
-		for root, _, files in outdir.walk():
-			for file in files:
-				on_disk = root / file
-				file = on_disk.relative_to(outdir)
-				fn = file.as_posix()
-				compress = False
-				if file_list:
-					if (fn + ".lz4") in file_list:
-						compress = True
-					elif not fn in file_list:
-						continue
-				else:
-					if include and not any(file.match(x) for x in include):
-						continue
-					if any(file.match(x) for x in exclude):
-						continue
-					compress = any(file.match(x) for x in compress_include)
-				data = b""
-				if compress:
-					from lz4fwrapper import compress_frame
-					data = compress_frame(on_disk.read_bytes(), 12)
-					fn += ".lz4"
-				# Offsets adjusted later
-				# TODO: weakref data
-				ret.files[fn] = FileEntry(fn, on_disk.stat().st_size, 1, 0, data)
-				# Length and filename, size, dummy
-				offset += 8 + len(fn) + 8 + 4
+		offset = HEADER_SIZE
+		to_compress = list[tuple[str, Path]]()
+		from .pipeline import scan
+		for on_disk, size in scan(outdir, jobs):
+			fn = on_disk.relative_to(outdir).as_posix()
+			compress = False
+			if file_list:
+				if (fn + ".lz4") in listed:
+					compress = True
+				elif not fn in listed:
+					continue
+			else:
+				if not filter(fn, size):
+					continue
+				compress = to_compress_globs(fn)
+			if compress:
+				fn += ".lz4"
+				to_compress.append((fn, on_disk))
+			# Offsets adjusted later, and with defer sizes too
+			ret.files.append(fn, size, 1, 0)
+			# Length and filename, size, dummy
+			offset += 8 + len(fn) + 8 + 4
+
+		if to_compress and not defer:
+			from .pipeline import ordered_map
+			def compress(item: tuple[str, Path]):
+				t = stats.clock()
+				data = item[1].read_bytes()
+				stats.emit("read", item[0], t, len(data))
+				t = stats.clock()
+				out = policy.compress(data, item[0], cache)
+				stats.emit("compress", item[0], t, len(data))
+				return out
+			for (fn, _), data in ordered_map(compress, to_compress, jobs=jobs):
+				entry = ret.files[fn]
+				entry.data = data
+				entry.size = len(data)
 
 		for fn in (file_list or ret.files.keys()):
 			file = ret.files[fn]
@@ -141,31 +495,79 @@ class PKG:
 		if fn not in self.files:
 			raise KeyError(f"{fn} not in file list")
 		entry = self.files[fn]
-		if not entry.size or entry.data:
-			return entry.data
-		
-		key = get_key()
-		with self.filename.open("rb") as f:
-			f.seek(entry.offset)
-			data = bytearray(f.read(entry.size))
-			if self.encrypted:
-				xor_buffer(data, key, entry.offset)
-			entry.data = bytes(data)
-			
-		if decompress and fn.endswith(".lz4"):
+		inflate = decompress and fn.endswith(".lz4")
+		if entry.data:
+			# Not written yet so there's nothing to cache
+			raw = entry.data
+		else:
+			key = (str(self.filename), fn, inflate)
+			data = self.cache.get(key)
+			if data is not None:
+				return data
+			raw = bytes(self.decrypt(fn)) if entry.size else b""
+
+		data = raw
+		if inflate and raw:
 			from lz4fwrapper import decompress_frame
-			return decompress_frame(entry.data)
-		return entry.data
+			t = stats.clock()
+			data = decompress_frame(raw)
+			stats.emit("decompress", fn, t, len(data))
+		if not entry.data:
+			self.cache.put(key, data)
+		return data
 
-	def write(self, archive: str|Path = "", outdir: str|Path = ""):
+	def open(self, fn: str, decompress=True):
+		"""
+		Seekable read-only file over an entry, see EntryReader. Small reads
+		of a large .lz4 entry only decompress the blocks they need.
+		"""
+		from .reader import EntryReader
+		if fn not in self.files:
+			raise KeyError(f"{fn} not in file list")
+		entry = self.files[fn]
+		if entry.data:
+			return EntryReader(memoryview(entry.data), None, 0, fn, decompress)
+		key = get_key() if self.encrypted else None
+		return EntryReader(self.view(fn), key, entry.offset, fn, decompress)
+
+	def _forget(self, fns: list[str]|None = None):
+		"""
+		Drop cached reads of the given entries, or all of them.
+		"""
+		filename = str(self.filename)
+		self.cache.discard(lambda key: key[0] == filename and (fns is None or key[1] in fns))
+
+	def write(self, archive: str|Path = "", outdir: str|Path = "",
+		jobs=1, memory_limit=256 << 20, cache: CompressionCache|None = None,
+		policy: CompressionPolicy|None = None,
+		progress: Callable[[int, int], None]|None = None, encrypt: bool|None = None,
+	):
+		"""
+		Write the pkg to archive, or back over its own file, encrypted if
+		encrypt is set or, by default, if it is now. Entries with no data in
+		memory are taken from outdir if given, otherwise copied from the
+		current file. .lz4 entries taken from outdir are compressed
+		following policy. With jobs other than 1, that's done that many at a
+		time (0 for one per CPU), and small files that aren't compressed are
+		read ahead too, with at most memory_limit bytes of source ahead of
+		the writer. Unchanged files compressed before are taken from cache
+		when given. progress is called with how many entries were written
+		so far and the total after each one.
+		"""
 		outpkg = Path(archive) if archive else self.filename
+		policy = policy or COMPRESSION
 		if not outpkg:
 			raise RuntimeError("must specify filename to write to")
 
-		files = sorted(self.files.values(), key=lambda f: f.offset)
+		files = self.files.sorted_by_offset()
 
 		datasrc = self.filename
+		# Can't rename a file that's mapped on Windows
+		self.close()
+		self._forget()
 		if outpkg.exists():
+			# Must check before it gets renamed
+			overwriting = bool(self.filename) and outpkg.samefile(self.filename)
 			if not self.backed_up:
 				backup = check_backup(outpkg)
 				outpkg.rename(backup)
@@ -173,36 +575,86 @@ class PKG:
 			else:
 				backup = get_backup_name(outpkg)
 
-			if outpkg.samefile(self.filename):
+			if overwriting:
 				datasrc = backup
 
 		self.filename = outpkg
 
 		key = get_key()
-		def fetch(entry: FileEntry, offset: int):
-			if entry.data:
-				data = bytearray(entry.data)
-				entry.size = len(data)  # just to be safe
+		# Data copied from the current file is as it's stored there
+		src_key = key if self.encrypted else None
+		if encrypt is not None:
+			self.encrypted = encrypt
+		def to_prepare(entry: FileEntry):
+			"""
+			File to read ahead of the writer for entry, and whether it's compressed.
+			"""
+			if entry.data or not outdir:
+				return None, False
+			if entry.name.endswith(".lz4"):
+				return (Path(outdir) / entry.name).with_suffix(""), True
+			# Bigger ones are streamed by the writer
+			if entry.size <= CHUNK_SIZE:
+				return Path(outdir) / entry.name, False
+			return None, False
+
+		def prepare(entry: FileEntry):
+			infile, compress = to_prepare(entry)
+			if not infile:
+				return None
+			t = stats.clock()
+			data = infile.read_bytes()
+			stats.emit("read", entry.name, t, len(data))
+			if not compress:
+				return data
+			t = stats.clock()
+			out = policy.compress(data, entry.name, cache)
+			stats.emit("compress", entry.name, t, len(data))
+			return out
+
+		def prepare_cost(entry: FileEntry):
+			infile, compress = to_prepare(entry)
+			if not infile:
+				return 0
+			return infile.stat().st_size if compress else entry.size
+
+		def put(entry: FileEntry, f: BinaryIO, offset: int, data: bytes|None = None):
+			out = CryptWriter(f, offset, key if self.encrypted else None, entry.name, buffer)
+			if data is None:
+				data = entry.data
+			if data:
+				out.write(data)
 			elif outdir:
 				infile = Path(outdir) / entry.name
 				if infile.suffix == ".lz4":
-					from lz4fwrapper import compress_frame
-					data = bytearray(compress_frame(infile.with_suffix("").read_bytes(), 12))
+					from lz4fwrapper import compress_stream
+					infile = infile.with_suffix("")
+					with infile.open("rb") as fin:
+						src = stats.TimedFile(fin, "read", entry.name) if stats.hooks else fin
+						t = stats.clock()
+						size = infile.stat().st_size
+						compress_stream(src, out, policy.choose_file(fin, size, entry.name), size)
+						if t:
+							# Whatever wasn't reading or writing
+							stats.emit("compress", entry.name, t + src.busy + out.busy,
+								infile.stat().st_size)
 				else:
-					data = bytearray(infile.read_bytes())
-				entry.size = len(data)
+					with infile.open("rb") as fin:
+						src = stats.TimedFile(fin, "read", entry.name) if stats.hooks else fin
+						shutil.copyfileobj(src, out, CHUNK_SIZE)
 			else:
-				with datasrc.open("rb") as f:
-					data = bytearray(f.seek(entry.offset).read(entry.size))
-					if self.encrypted:
-						xor_parallel(data, key, entry.offset)
-			
-			if self.encrypted:
-				xor_parallel(data, key, offset)
+				copy_data(source, f, entry.offset, offset, entry.size, src_key, out.key,
+					entry.name, buffer)
+				entry.offset = offset
+				return
+
+			entry.size = out.written
 			entry.offset = offset
-			return data
 
-		with outpkg.open("wb") as f:
+		# Entries copied from the current file all read through one handle
+		copying = not outdir and any(not x.data for x in files)
+		buffer = ScratchBuffer()
+		with datasrc.open("rb") if copying else nullcontext() as source, outpkg.open("wb") as f:
 			# Write header
 			header_b = bytearray(
 				(0).to_bytes(4, "big")
@@ -244,13 +696,22 @@ class PKG:
 			f.seek(offset)
 
 			# Write file data
+			if jobs == 1 and not cache:
+				# Everything's streamed in as it's written
+				ready = ((file, None) for file in files)
+			else:
+				from .pipeline import ordered_map
+				ready = ordered_map(prepare, files, jobs=jobs,
+					cost=prepare_cost, memory_limit=memory_limit)
 			size_changed = list[int]()
-			for i, file in enumerate(files):
+			for i, (file, data) in enumerate(ready):
 				pre_size = file.size
-				f.write(fetch(file, offset))
+				put(file, f, offset, data)
 				offset += file.size
 				if pre_size != file.size:
 					size_changed.append(i)
+				if progress:
+					progress(i + 1, len(files))
 
 			# Re-write file sizes
 			for i in size_changed:
@@ -264,121 +725,307 @@ class PKG:
 			return offset
 
 	def export(self, fn: str, outdir: str|Path, decompress=True):
-		outdir = Path(outdir)
-		data = self.read(fn, decompress)
-		entry = self.files[fn]
-		fp = outdir / entry.name
+		data = self.read(fn, decompress=False)
+		self._export_data(fn, data, outdir, decompress,
+			compressed=decompress and fn.endswith(".lz4") and bool(data))
+
+	def _export_data(self, fn: str, data, outdir: str|Path, decompress: bool,
+		compressed=False,
+	):
+		"""
+		Save an entry under outdir. If compressed, data is still an LZ4 frame
+		and is decompressed in pieces as it's written out.
+		"""
+		fp = Path(outdir) / fn
 		if decompress and fp.suffix == ".lz4":
-			# Already decompressed by read, just change suffix
 			fp = fp.with_suffix("")
-		if fp.exists():
-			if not CHECK_CONTENTS_BEFORE_BACKUP or fp.read_bytes() != data:
-				fp.rename(check_backup(fp))
-		else:
+
+		def save(dest: Path):
+			if compressed:
+				from lz4fwrapper import FrameDecompressor
+				with dest.open("wb") as f:
+					sink = stats.TimedFile(f, "write", fn) if stats.hooks else f
+					t = stats.clock()
+					with FrameDecompressor(sink) as dec:
+						dec.write(data)
+					if t:
+						# Whatever wasn't writing
+						stats.emit("decompress", fn, t + sink.busy, dec.bytes_out)
+			else:
+				t = stats.clock()
+				dest.write_bytes(data)
+				stats.emit("write", fn, t, len(data))
+
+		if not fp.exists():
 			fp.parent.mkdir(exist_ok=True, parents=True)
-		fp.write_bytes(data)
+		elif not CHECK_CONTENTS_BEFORE_BACKUP:
+			fp.rename(check_backup(fp))
+		elif compressed:
+			# Compare on disk rather than holding the decompressed data
+			tmp = fp.with_name(fp.name + ".tmp")
+			save(tmp)
+			if filecmp.cmp(tmp, fp, shallow=False):
+				tmp.unlink()
+			else:
+				fp.rename(check_backup(fp))
+				tmp.rename(fp)
+			return
+		elif fp.read_bytes() != data:
+			fp.rename(check_backup(fp))
+		save(fp)
 
 	def export_all(self, outdir: str|Path,
 		include: list[str] = [], exclude: list[str] = [],
-		decompress = True
+		decompress = True, jobs = 1, memory_limit = 256 << 20,
+		filter: Filter|None = None,
 	):
-		outdir = Path(outdir)
+		"""
+		Export all entries matching the filters. With jobs other than 1, reads,
+		decryption, decompression and writes run concurrently on that many
+		workers (0 for one per CPU) with at most memory_limit bytes in flight.
+		"""
+		return self.export_many(self.select(include, exclude, filter), outdir,
+			decompress=decompress, jobs=jobs, memory_limit=memory_limit)
+
+	def select(self, include: list[str] = [], exclude: list[str] = [],
+		filter: Filter|None = None,
+	):
+		"""
+		Names of the entries passing filter, in table order. Without one,
+		entries matching or containing an include pattern and matching no
+		exclude pattern.
+		"""
+		filter = filter or Filter(include, exclude, substring=True)
+		return [self.files.name(x) for x in filter.rows(self.files)]
+
+	def export_many(self, names: list[str], outdir: str|Path,
+		decompress=True, jobs=1, memory_limit=256 << 20,
+	):
+		"""
+		Export the given entries, see export_all.
+		"""
+		if jobs != 1:
+			from .pipeline import export_parallel
+			return export_parallel(self, names, outdir, decompress=decompress,
+				jobs=jobs, memory_limit=memory_limit)
+
 		exported = 0
-		if not self.files:
-			return exported
-		# Get first offset and read whole file into memory
-		offset = min(x.offset for x in self.files.values())
-		key = get_key()
-		with self.filename.open("rb") as f:
-			f.seek(offset)
-			data = bytearray(f.read())
-			if self.encrypted:
-				xor_parallel(data, key, offset)
-		f = BytesIO(data)
-		for fn, entry in self.files.items():
-			file = Path(fn)
-			if include and not any(x in fn or file.match(x) for x in include):
-				continue
-			if any(file.match(x) for x in exclude):
-				continue
-			f.seek(entry.offset - offset)
-			entry.data = f.read(entry.size)
-			self.export(fn, outdir, decompress=decompress)
+		# Entries are decrypted one at a time into the same buffer
+		buffer = ScratchBuffer()
+		for fn in names:
+			entry = self.files[fn]
+			data = entry.data or self.decrypt(fn, buffer)
+			self._export_data(fn, data, outdir, decompress,
+				compressed=decompress and fn.endswith(".lz4") and bool(data))
 			exported += 1
 		return exported
-	
-	def import1(self, fn: str, outdir: str|Path, prefer_compressed=False):
-		outdir = Path(outdir)
+
+	def verify(self, names: list[str]|None = None, jobs=0, memory_limit=256 << 20):
+		"""
+		Check the file as loaded: that the table, entry offsets and sizes add
+		up to its length, and that each .lz4 entry (of names, or all of them)
+		decrypts to a valid frame with matching checksums, on jobs threads
+		(0 for one per CPU). Nothing is written. Returns (name, problem)
+		pairs, where problems with the file as a whole have no name.
+		"""
+		from lz4fwrapper import verify_frame
+		from .pipeline import ordered_map
+		problems = list[tuple[str, str]]()
+		size = self.filename.stat().st_size
+		files = self.files.sorted_by_offset()
+		end = len(self._table_bytes({}))
+		for entry in files:
+			if entry.offset != end:
+				problems.append((entry.name, f"starts at 0x{entry.offset:x} instead of 0x{end:x}"))
+			end = entry.offset + entry.size
+			if end > size:
+				problems.append((entry.name, f"ends 0x{end - size:x} bytes past the end of the file"))
+		if end < size:
+			problems.append(("", f"0x{size - end:x} bytes after the last entry"))
+
+		wanted = None if names is None else set(names)
+		frames = [x.name for x in files if x.name.endswith(".lz4") and x.size
+			and x.offset + x.size <= size and (wanted is None or x.name in wanted)]
+		buffers = local()
+		def check(fn: str):
+			if not hasattr(buffers, "buffer"):
+				buffers.buffer = ScratchBuffer()
+			data = self.decrypt(fn, buffers.buffer)
+			t = stats.clock()
+			try:
+				stats.emit("decompress", fn, t, verify_frame(data))
+			except RuntimeError as err:
+				return str(err)
+			return None
+		for fn, problem in ordered_map(check, frames, jobs=jobs,
+			cost=lambda x: self.files[x].size, memory_limit=memory_limit,
+		):
+			if problem:
+				problems.append((fn, problem))
+		return problems
+
+	def import_data(self, fn: str, outdir: str|Path, prefer_compressed=False,
+		policy: CompressionPolicy|None = None, cache: CompressionCache|None = None,
+	):
+		"""
+		Load the replacement for an entry from outdir as it'd be stored,
+		compressing it following policy if the entry is .lz4 and there's no
+		compressed copy (or prefer_compressed is off), through cache if given.
+		"""
 		if fn not in self.files:
 			raise KeyError(f"{fn} not in file list")
-		entry = self.files[fn]
-
-		# Get file to import
-		infile = outdir / entry.name
+		infile = Path(outdir) / fn
 		if infile.suffix == ".lz4" and not (prefer_compressed and infile.exists()):
-			from lz4fwrapper import compress_frame
-			data = bytearray(compress_frame(infile.with_suffix("").read_bytes(), 12))
-		else:
-			data = bytearray(infile.read_bytes())
+			data = infile.with_suffix("").read_bytes()
+			t = stats.clock()
+			out = (policy or COMPRESSION).compress(data, fn, cache)
+			stats.emit("compress", fn, t, len(data))
+			return out
+		return infile.read_bytes()
 
-		if not self.backed_up:
-			backup = check_backup(self.filename)
-			self.filename.rename(backup)
-			self.backed_up = True
-		else:
-			backup = get_backup_name(self.filename)
-		
-		key = get_key()
-		with backup.open("rb") as fin, self.filename.open("wb") as fout:
-			offset = next(iter(self.files.values())).offset
-			header = BytesIO()
-			header.write(offset.to_bytes(4))
-			header.write(len(self.format).to_bytes(8))
-			header.write(self.format.encode("ascii"))
-			header.write(len(self.version).to_bytes(8))
-			header.write(self.version.encode("ascii"))
-			header.write(self.count.to_bytes(8))
-			for k, v in self.files.items():
-				header.write(len(k).to_bytes(8))
-				header.write(k.encode("ascii"))
-				sz = len(data) if k == fn else v.size
-				header.write(sz.to_bytes(8))
-				header.write(v.dummy.to_bytes(4))
-			header = bytearray(header.getbuffer())
-			if self.encrypted:
-				xor_parallel(header, key, 0)
-			fout.write(header)
-			assert fout.tell() == offset
-
-			# Write data
-			fin.seek(offset)
-			intro = fin.read(entry.offset - offset)
-			fout.write(intro)
-			fin.seek(entry.size, 1)
-			outro_offset = fin.tell()
-			outro = bytearray(fin.read())
-			if self.encrypted:
-				xor_parallel(outro, key, outro_offset)  # decrypt
-			assert fout.tell() == entry.offset
-			if self.encrypted:
-				xor_parallel(data, key, fout.tell())
-			fout.write(data)
-			if self.encrypted:
-				xor_parallel(outro, key, fout.tell())  # encrypt
-			fout.write(outro)
+	def import1(self, fn: str, outdir: str|Path, prefer_compressed=False,
+		policy: CompressionPolicy|None = None, backup=True,
+		cache: CompressionCache|None = None,
+	):
+		return self.import_files([fn], outdir, prefer_compressed, policy=policy,
+			backup=backup, cache=cache)
+
+	def import_files(self, fns: list[str], outdir: str|Path|dict[str, str|Path],
+		prefer_compressed=False, jobs=1, policy: CompressionPolicy|None = None,
+		backup=True, cache: CompressionCache|None = None,
+	):
+		"""
+		Replace several entries with their files from outdir, or from each
+		entry's own folder if it maps names to folders, in a single pass,
+		loading (and compressing) them on jobs threads. backup is as for
+		replace.
+		"""
+		from .pipeline import ordered_map
+		def load(fn: str):
+			src = outdir[fn] if isinstance(outdir, dict) else outdir
+			return self.import_data(fn, src, prefer_compressed, policy, cache)
+		return self.replace(dict(ordered_map(load, fns, jobs=jobs)), backup)
+
+	def _table_bytes(self, sizes: dict[str, int]):
+		"""
+		Unencrypted header and file table, with sizes overriding entry sizes.
+		"""
+		header = BytesIO()
+		header.write(bytes(4))
+		header.write(len(self.format).to_bytes(8))
+		header.write(self.format.encode("ascii"))
+		header.write(len(self.version).to_bytes(8))
+		header.write(self.version.encode("ascii"))
+		header.write(len(self.files).to_bytes(8))
+		for k, v in self.files.items():
+			header.write(len(k).to_bytes(8))
+			header.write(k.encode("ascii"))
+			header.write(sizes.get(k, v.size).to_bytes(8))
+			header.write(v.dummy.to_bytes(4))
+		header = bytearray(header.getbuffer())
+		header[:4] = len(header).to_bytes(4)
+		return header
+
+	def _size_field_offset(self, fn: str):
+		row = self.files.row(fn)
+		# Every entry before is 20 bytes plus its name, and name_starts is
+		# the total length of the names before plus one newline each
+		before = self.files.name_starts[row] - row
+		return (4 + 8 + len(self.format) + 8 + len(self.version) + 8
+			+ 20 * row + before + 8 + len(fn))
+
+	def _save_undo(self, undo: Path, ranges: list[tuple[int, int]]):
+		"""
+		Add the bytes of the file in (offset, size) ranges to undo, started
+		over unless it's for the file as it is now.
+		"""
+		with self.filename.open("rb") as fin:
+			if _undo_header(undo, self.filename):
+				# Undoing goes back to before the earlier replaces too
+				f = undo.open("ab")
+			else:
+				f = check_backup(self.filename, undo).open("wb")
+				f.write(UNDO_MAGIC + fin.seek(0, os.SEEK_END).to_bytes(8, "big") + bytes(16))
+			with f:
+				for offset, size in ranges:
+					fin.seek(offset)
+					f.write(offset.to_bytes(8, "big") + size.to_bytes(8, "big") + fin.read(size))
 
+	def replace(self, replacements: dict[str, bytes|bytearray], backup=True):
+		"""
+		Replace the stored data of several entries in one go. Entries that
+		keep their size, or the last entry in the archive, are patched in
+		place. Otherwise the archive is rewritten in one streaming pass,
+		with unchanged data before the first resized entry copied as-is.
+		A rewrite always leaves the old file as the backup. Patching in place
+		instead saves just the bytes it overwrites to an undo file next to
+		the archive, unless backup is off, see undo_in_place.
+		Returns whether it was patched in place.
+		"""
+		for fn in replacements:
+			if fn not in self.files:
+				raise KeyError(f"{fn} not in file list")
+		if not replacements:
+			return True
+		self.close()
+		self._forget(list(replacements))
+		key = get_key() if self.encrypted else None
+		files = self.files.sorted_by_offset()
+		resized = [fn for fn, data in replacements.items() if len(data) != self.files[fn].size]
 
-@dataclass
-class FileEntry:
-	# Part of the table
-	name: str
-	size: int
-	dummy: int  # version? count? always(?) 1
+		def encrypted(data: bytes|bytearray, offset: int):
+			if not key:
+				return data
+			data = bytearray(data)
+			xor_parallel(data, key, offset)
+			return data
 
-	# Extra info
-	offset: int
-	data: bytes = b""
+		if not resized or resized == [files[-1].name]:
+			undo = get_undo_name(self.filename) if backup and not self.backed_up else None
+			if undo:
+				ranges = [(self.files[fn].offset, self.files[fn].size) for fn in replacements]
+				if resized:
+					ranges.append((self._size_field_offset(files[-1].name), 8))
+				self._save_undo(undo, ranges)
+			with self.filename.open("r+b") as f:
+				for fn, data in replacements.items():
+					entry = self.files[fn]
+					f.seek(entry.offset)
+					f.write(encrypted(data, entry.offset))
+				if resized:
+					entry = files[-1]
+					entry.size = len(replacements[entry.name])
+					sz_offset = self._size_field_offset(entry.name)
+					f.seek(sz_offset)
+					f.write(encrypted(entry.size.to_bytes(8), sz_offset))
+					f.truncate(entry.offset + entry.size)
+			if undo:
+				# Tie it to the file as patched
+				st = self.filename.stat()
+				with undo.open("r+b") as f:
+					f.seek(12)
+					f.write(st.st_size.to_bytes(8, "big") + st.st_mtime_ns.to_bytes(8, "big"))
+			return True
 
-	def compress(self, data: bytes):
-		from lz4fwrapper import compress_frame
-		self.data = bytearray(compress_frame(data, 12))
+		if not self.backed_up:
+			backup_fn = check_backup(self.filename)
+			self.filename.rename(backup_fn)
+			self.backed_up = True
+		else:
+			backup_fn = get_backup_name(self.filename)
+
+		header = self._table_bytes({fn: len(data) for fn, data in replacements.items()})
+		with backup_fn.open("rb") as fin, self.filename.open("wb") as fout:
+			fout.write(encrypted(header, 0))
+			offset = len(header)
+			for entry in files:
+				assert fout.tell() == offset
+				if entry.name in replacements:
+					data = replacements[entry.name]
+					fout.write(encrypted(data, offset))
+					entry.size = len(data)
+				else:
+					copy_data(fin, fout, entry.offset, offset, entry.size, key, key)
+				entry.offset = offset
+				offset += entry.size
+		return False
@@ -4,6 +4,8 @@ import sys
 from pathlib import Path
 
 from . import *
+from .filters import Filter, parse_size
+from .policy import FAST_LEVEL, MAX_LEVEL, CompressionPolicy, parse_level, parse_override
 
 def crypt(src: Path, dest: Path):
 	key = get_key()
@@ -28,6 +30,12 @@ def encrypt(src: Path, dest: Path):
 	print(f"Encrypting {src} to {dest}")
 	crypt(src, dest)
 
+def level_override(text: str):
+	try:
+		return parse_override(text)
+	except ValueError as err:
+		raise argparse.ArgumentTypeError(str(err))
+
 parser = argparse.ArgumentParser("DividedPKG", description="Packer and unpacker for Indivisible game")
 group = parser.add_mutually_exclusive_group()
 group.add_argument("--unpack", "-u", action="store_true",
@@ -35,108 +43,281 @@ group.add_argument("--unpack", "-u", action="store_true",
 group.add_argument("--pack", "-p", action="store_true",
 	help="Pack the given directory or file(s) into the given pkg file")
 group.add_argument("--list", "-l", action="store_true",
-	help="List the contents of the given pkg file(s)")
+	help="List the contents of the given pkg file(s) or of every pkg in the given folder")
+group.add_argument("--diff", "-D", action="store_true",
+	help="Write a patch with what changed from the first given pkg to the second")
+group.add_argument("--apply", "-A", action="store_true",
+	help="Apply the given patch to the given pkg, writing the result to the last path")
+group.add_argument("--verify", "-V", action="store_true",
+	help="Check the given pkg file(s), or every pkg in the given folder, for damage")
+group.add_argument("--undo", action="store_true",
+	help="Put back what was last imported in place into the given pkg file(s)")
+group.add_argument("--serve", action="store_true",
+	help="Keep running as a local server that --list and --unpack are forwarded to while it's up")
 gcrypt = parser.add_mutually_exclusive_group()
 gcrypt.add_argument("--decrypt", "-d", action="store_true",
 	help="Decrypt the given pkg file(s)")
 gcrypt.add_argument("--encrypt", "-e", action="store_true",
 	help="Encrypt the given pkg file(s)")
-gcompress = parser.add_mutually_exclusive_group()
-gcompress.add_argument("--compress", "-C", action="store_true",
+# Not a mutually exclusive group, argparse can't format usage for one of
+# hidden options when it has to wrap
+parser.add_argument("--compress", "-C", action="store_true",
 	help=argparse.SUPPRESS)
-gcompress.add_argument("--uncompress", "-U", action="store_true",
+parser.add_argument("--uncompress", "-U", action="store_true",
 	help=argparse.SUPPRESS)
 parser.add_argument("--include", "-i", action="append",
 	help="Include only files which match this glob (can be specified multiple times)")
 parser.add_argument("--exclude", "-x", action="append",
 	help="Exclude any files which match this glob (can be specified multiple times)")
+parser.add_argument("--min-size", type=parse_size,
+	help="Only act on files of at least this size (bytes, or with a K, M or G suffix)")
+parser.add_argument("--max-size", type=parse_size,
+	help="Only act on files of at most this size (bytes, or with a K, M or G suffix)")
+parser.add_argument("--ext", action="append",
+	help="Only act on files with this extension, ignoring .lz4 (can be specified multiple times)")
 parser.add_argument("--compress-include", "-c", action="append",
 	help=("Compress files which match this glob (can be specified multiple times). "
 		"Only used with --pack when creating a pkg file from scratch."))
+parser.add_argument("--jobs", "-j", type=int, default=1,
+	help=("Number of worker threads to use with --unpack or --pack, 0 for one per CPU (default 1). "
+		"With several pkgs, --unpack and --list use this many processes instead."))
+parser.add_argument("--cache", "-k", action="store_true",
+	help="With --pack, keep compressed files between runs and reuse them for unchanged files")
+parser.add_argument("--cache-dir", type=Path,
+	help="Where to keep the --cache files (default: the user's cache folder)")
+parser.add_argument("--index", action="store_true",
+	help="Keep each pkg's file table in the user's cache folder so loading it again is instant")
+parser.add_argument("--level", "-L", type=parse_level, default=MAX_LEVEL,
+	help=(f"LZ4 level for compressed files, {MAX_LEVEL} is the smallest and slowest, 3 and up use "
+		f"LZ4 HC, 1 or less the fast compressor, or 'store' (default {MAX_LEVEL})"))
+parser.add_argument("--fast", "-F", action="store_const", dest="level", const=FAST_LEVEL,
+	help=f"Quick compression for test builds, same as --level {FAST_LEVEL}")
+parser.add_argument("--level-for", action="append", type=level_override, metavar="GLOB=LEVEL",
+	help="Use a different --level for files which match this glob (can be specified multiple times)")
+parser.add_argument("--min-gain", type=float, default=0,
+	help="Store files that compress by less than this percentage (default 0)")
+parser.add_argument("--no-sample", action="store_true",
+	help="Compress everything, instead of storing files that a sample shows won't compress")
+parser.add_argument("--stats", action="store_true",
+	help="Print how long each stage (load, read, xor, compress, decompress, write) took")
+parser.add_argument("--progress", action="store_true",
+	help="With --pack, show how many files have been written so far")
+parser.add_argument("--port", type=int, default=0,
+	help="Port for --serve to listen on, on localhost only (default: any free one)")
+parser.add_argument("--no-server", action="store_true",
+	help="Don't forward to a running --serve, do the work in this process")
 parser.add_argument("src", nargs="*", type=Path)
-parser.add_argument("dest", type=Path)
+parser.add_argument("dest", nargs="?", type=Path)
 args = parser.parse_args()
+if args.compress and args.uncompress:
+	parser.error("argument --uncompress/-U: not allowed with argument --compress/-C")
+# Optional only for --serve, otherwise it's the last path given
+if args.dest is None and args.src:
+	args.dest = args.src.pop()
+if args.dest is None and not args.serve:
+	parser.error("the following arguments are required: dest")
 
 include = list[str](args.include or [])
 exclude = list[str](args.exclude or [])
 compress_include = list[str](args.compress_include or [])
+wanted = Filter(include, exclude, min_size=args.min_size, max_size=args.max_size,
+	extensions=list[str](args.ext or []))
+# Unpacking also takes includes that are just part of a name
+unpacking = Filter(include, exclude, min_size=args.min_size, max_size=args.max_size,
+	extensions=list[str](args.ext or []), substring=True)
 src = list[Path](args.src or [])
-dest = Path(args.dest)
-encrypted = args.encrypt if args.decrypt is None else not args.decrypt
+dest = Path(args.dest or ".")
+# Guessed from the file unless told otherwise
+encrypted = True if args.encrypt else False if args.decrypt else None
+index = IndexCache(args.cache_dir / "index" if args.cache_dir else None) if args.index else None
+policy = CompressionPolicy(args.level, min_gain=args.min_gain / 100, sample=not args.no_sample,
+	overrides=list(args.level_for or []))
+if args.stats:
+	import atexit
+	from .stats import Stats
+	collected = Stats().start()
+	# Commands exit from all over the place
+	atexit.register(lambda: print(collected.stop().summary(), file=sys.stderr))
+client = None
+if (args.list or args.unpack) and not (args.no_server or args.stats):
+	# Timings are of this process, so --stats never forwards
+	from .server import Client
+	client = Client.connect()
 
 try:
-	if args.list:
+	if args.serve:
+		from .server import PKGServer
+		server = PKGServer(args.port, index=index)
+		print(f"Serving on 127.0.0.1:{server.server_address[1]}", flush=True)
+		try:
+			server.serve()
+		except KeyboardInterrupt:
+			pass
+		sys.exit(0)
+	elif args.list and dest.is_dir():
+		# Everything in an install folder, with the pkg each file comes from
+		from .pkgset import PKGSet
+		with PKGSet.load(dest, encrypted=encrypted, index=index) as pkgs:
+			print(f"{'pkg':16s}, {'size':10s}, name")
+			for name in pkgs:
+				pkg, entry = pkgs.locate(name)
+				if wanted(name, entry.size):
+					print(f"{pkg.filename.name:16s}, 0x{entry.size:08x}, {name}")
+		sys.exit(0)
+	elif args.list:
+		from functools import partial
+		from .pipeline import get_jobs, list_pkg
+		pkg_fns = [*src, dest]
 		print_filename = bool(src)
-		for pkg_fn in [*src, dest]:
-			pkg = PKG.load(dest, encrypted=encrypted)
+		listing = partial(list_pkg, filter=wanted, encrypted=encrypted, index=index)
+		if client:
+			listings = (client.list(x, wanted, encrypted) for x in pkg_fns)
+		elif len(pkg_fns) > 1 and args.jobs != 1:
+			# Loaded in parallel but printed in order
+			from concurrent.futures import ProcessPoolExecutor
+			pool = ProcessPoolExecutor(min(get_jobs(args.jobs), len(pkg_fns)))
+			listings = pool.map(listing, pkg_fns)
+		else:
+			listings = map(listing, pkg_fns)
+		for pkg_fn, lines in zip(pkg_fns, listings):
 			if print_filename:
-				print("# {pkg_fn}:")
-			print(f"{'offset':18s}, {'size':10s}, name")
-			for entry in pkg.files.values():
-				file = Path(entry.name)
-				if (
-					(not include or any(file.match(x) for x in include))
-					and not any(file.match(x) for x in exclude)
-				):
-					print(f"0x{entry.offset:016x}, 0x{entry.size:08x}, {entry.name}")
+				print(f"# {pkg_fn}:")
+			print("\n".join(lines))
+		sys.exit(0)
+	elif args.verify:
+		if dest.is_dir():
+			from .pkgset import pkg_order
+			pkg_fns = sorted((x for x in dest.glob("*.pkg") if x.is_file()), key=pkg_order)
+		else:
+			pkg_fns = [*src, dest]
+		bad = 0
+		for pkg_fn in pkg_fns:
+			pkg = PKG.load(pkg_fn, encrypted=encrypted, index=index)
+			names = pkg.select(filter=unpacking)
+			problems = pkg.verify(names, jobs=args.jobs)
+			pkg.close()
+			for name, problem in problems:
+				print(f"{pkg_fn}: {name + ': ' if name else ''}{problem}")
+			bad += len(problems)
+		print(f"Checked {len(pkg_fns)} pkg(s), {bad} problem(s) found")
+		sys.exit(1 if bad else 0)
+	elif args.undo:
+		for pkg_fn in [*src, dest]:
+			try:
+				undo_in_place(pkg_fn)
+			except ValueError as err:
+				print(str(err), file=sys.stderr)
+				sys.exit(1)
+			print(f"Restored {pkg_fn}")
+		sys.exit(0)
+	elif args.diff or args.apply:
+		from . import patch
+		if len(src) != 2:
+			print("Expected two pkgs and a patch" if args.diff else "Expected a pkg, a patch and an output",
+				file=sys.stderr)
+			sys.exit(1)
+		base = PKG.load(src[0], encrypted=encrypted, index=index)
+		if args.diff:
+			reused, changed = patch.diff(base, PKG.load(src[1], encrypted=encrypted, index=index), dest)
+			print(f"Wrote {dest} with {changed} changed file(s), {reused} taken from {src[0]}")
+		else:
+			pkg = patch.apply(base, src[1], dest, verify=True)
+			print(f"Wrote {len(pkg.files)} to {dest}")
 		sys.exit(0)
 	elif args.pack:
 		outdir = ""
+		cache = None
+		if args.cache or args.cache_dir:
+			from .cache import CompressionCache
+			cache = CompressionCache(args.cache_dir)
 		if dest.is_file():
 			pkg = PKG.load(dest)
-			if len(src) == 1 and src[0].is_file():
-				ssrc = src[0].as_posix()
-				for fn in pkg.files.keys():
-					fn2 = fn.removesuffix(".lz4")
-					if ssrc.endswith(fn2):
-						outdir = ssrc[:-len(fn2)]
-						pkg.import1(fn, outdir)
-						print(f"Imported 1 file into {dest}")
-						sys.exit(0)
-				raise FileNotFoundError(f"Could not find file in pkg: {ssrc}")
+			if src and all(x.is_file() for x in src):
+				imports = dict[str, str]()
+				for file in src:
+					ssrc = file.as_posix()
+					for fn in pkg.files.keys():
+						fn2 = fn.removesuffix(".lz4")
+						if ssrc.endswith(fn2):
+							imports[fn] = ssrc[:-len(fn2)]
+							break
+					else:
+						raise FileNotFoundError(f"Could not find file in pkg: {ssrc}")
+				in_place = pkg.import_files(list(imports), imports, jobs=args.jobs,
+					policy=policy, cache=cache)
+				print(f"Imported {len(imports)} file(s) into {dest}"
+					+ (" in place" if in_place else ""))
+				sys.exit(0)
+			elif len(src) == 1 and src[0].is_dir():
+				# Repack from an unpacked folder
+				outdir = src[0]
 		elif len(src) > 1 or src and src[0].is_file():
 			import os.path
 			outdir = Path(os.path.commonpath(src))
 			# TODO?: expand directories
 			pkg = PKG.create(outdir, encrypt=not args.decrypt,
-				file_list=[x.relative_to(outdir).as_posix() for x in src])
+				file_list=[x.relative_to(outdir).as_posix() for x in src],
+				jobs=args.jobs)
 		elif src:
 			outdir = src[0]
 			pkg = PKG.create(outdir, encrypt=not args.decrypt,
-				include=include, exclude=exclude, compress_include=compress_include)
+				filter=wanted, compress_include=compress_include,
+				jobs=args.jobs)
 		elif dest.is_dir():
 			outdir = dest
 			dest = dest.with_suffix(".pkg")
 			pkg = PKG.create(outdir, encrypt=not args.decrypt,
-				include=include, exclude=exclude, compress_include=compress_include)
+				filter=wanted, compress_include=compress_include,
+				jobs=args.jobs)
 		else:
 			print("Dunno what to pack", file=sys.stderr)
 			sys.exit(1)
-		pkg.write(dest, outdir)
+		from time import monotonic
+		shown = 0.0
+		def progress(done: int, total: int):
+			global shown
+			now = monotonic()
+			# A few times a second is plenty
+			if done < total and now - shown < 0.2:
+				return
+			shown = now
+			print(f"\rWriting {dest}: {done}/{total} files", end="" if done < total else "\n",
+				file=sys.stderr, flush=True)
+		pkg.write(dest, outdir, jobs=args.jobs, cache=cache, policy=policy,
+			progress=progress if args.progress else None)
 		print(f"Wrote {len(pkg.files)} to {dest}")
 		sys.exit(0)
 	elif not args.unpack:
 		if args.compress:
-			from lz4fwrapper import compress_frame
+			from lz4fwrapper import compress_stream
 			count = 0
 			for file in [*src, dest]:
-				file.with_suffix(file.suffix + ".lz4").write_bytes(
-					compress_frame(file.read_bytes(), 12))
+				with (
+					file.open("rb") as fin,
+					file.with_suffix(file.suffix + ".lz4").open("wb") as fout,
+				):
+					size = file.stat().st_size
+					compress_stream(fin, fout, policy.choose_file(fin, size, file.name), size)
 				count += 1
 			print(f"Compressed {count} files")
 			sys.exit(0)
 		elif args.uncompress:
-			from lz4fwrapper import decompress_frame
+			from lz4fwrapper import decompress_stream
 			for file in [*src, dest]:
+				if file.suffix == ".lz4":
+					out = file.with_suffix("")
+				else:
+					out = file.with_stem(file.stem + "_decompressed")
+				# Don't clobber the output until it's known to be good
+				tmp = out.with_name(out.name + ".tmp")
 				try:
-					data = decompress_frame(file.read_bytes())
+					with file.open("rb") as fin, tmp.open("wb") as fout:
+						decompress_stream(fin, fout)
 				except:
+					tmp.unlink(missing_ok=True)
 					print(f"Failed to decompress file: {file}")
 					continue
-				if file.suffix == ".lz4":
-					file.with_suffix("").write_bytes(data)
-				else:
-					file.with_stem(file.stem + "_decompressed").write_bytes(data)
+				tmp.replace(out)
 			sys.exit(0)
 
 	add_name = False
@@ -151,10 +332,24 @@ try:
 		if not src:
 			src = [dest]
 			dest = dest.with_suffix("")
-		for s in src:
-			out = dest / s.with_suffix("") if add_name else dest
-			out.mkdir(exist_ok=True)
-			PKG.load(s, encrypted=encrypted).export_all(out, include, exclude, decompress=not args.compress)
+		pkgs = [(s, dest / s.with_suffix("") if add_name else dest) for s in src]
+		for _, out in pkgs:
+			out.mkdir(parents=True, exist_ok=True)
+		if client:
+			for s, out in pkgs:
+				client.export(s, out, unpacking, decompress=not args.compress, jobs=args.jobs,
+					encrypted=encrypted)
+		elif len(pkgs) > 1 and args.jobs != 1:
+			# Several pkgs split between processes instead of threads in each
+			from .pipeline import unpack_many
+			for s, count in unpack_many(pkgs, unpacking, decompress=not args.compress,
+				processes=args.jobs, encrypted=encrypted, index=index,
+			):
+				print(f"Unpacked {count} files from {s}")
+		else:
+			for s, out in pkgs:
+				PKG.load(s, encrypted=encrypted, index=index).export_all(out,
+					decompress=not args.compress, jobs=args.jobs, filter=unpacking)
 	elif args.decrypt:
 		for s in src:
 			decrypt(s, dest / s.with_suffix("") if add_name else dest)
@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import Executor
+from pathlib import Path
+
+from . import PKG
+from .index import IndexCache
+
+
+class AsyncPKG:
+	"""
+	Asyncio front end to a PKG. Reads, decryption and decompression run on
+	an executor so the event loop isn't blocked, at most concurrency at a
+	time. Concurrent reads of the same entry share one read.
+
+	Several AsyncPKGs can share a limit by passing the same Semaphore.
+	"""
+	def __init__(self, pkg: PKG, *,
+		concurrency: int|asyncio.Semaphore = 32, executor: Executor|None = None,
+	):
+		self.pkg = pkg
+		self.executor = executor
+		self._limit = (concurrency if isinstance(concurrency, asyncio.Semaphore)
+			else asyncio.Semaphore(concurrency))
+		self._reads = dict[tuple[str, bool], asyncio.Future[bytes]]()
+
+	@classmethod
+	async def load(cls, fn: str|Path, encrypted: bool|None = None,
+		index: IndexCache|None = None, *,
+		concurrency: int|asyncio.Semaphore = 32, executor: Executor|None = None,
+	):
+		ret = cls(PKG(), concurrency=concurrency, executor=executor)
+		ret.pkg = await ret._run(PKG.load, fn, encrypted, index)
+		return ret
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *_):
+		self.close()
+
+	def close(self):
+		self.pkg.close()
+
+	@property
+	def files(self):
+		return self.pkg.files
+
+	async def _run(self, func, *args):
+		async with self._limit:
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(self.executor, func, *args)
+
+	async def read(self, fn: str, decompress=True) -> bytes:
+		"""
+		PKG.read off the event loop. Cancelling one caller doesn't cancel
+		the read for others waiting on the same entry.
+		"""
+		if fn not in self.pkg.files:
+			raise KeyError(f"{fn} not in file list")
+		key = (fn, decompress)
+		fut = self._reads.get(key)
+		if fut is None:
+			fut = asyncio.ensure_future(self._run(self.pkg.read, fn, decompress))
+			self._reads[key] = fut
+			def done(fut: asyncio.Future[bytes]):
+				self._reads.pop(key, None)
+				# Callers cancelled meanwhile would leave an error unretrieved
+				if not fut.cancelled():
+					fut.exception()
+			fut.add_done_callback(done)
+		return await asyncio.shield(fut)
+
+	async def read_many(self, fns: list[str], decompress=True):
+		"""
+		Read several entries at once, returned in the same order. If any
+		fail, the first error is raised once all of them are done.
+		"""
+		# Waiting for all of them leaves no failed read unretrieved
+		ret = await asyncio.gather(*(self.read(fn, decompress) for fn in fns),
+			return_exceptions=True)
+		for x in ret:
+			if isinstance(x, BaseException):
+				raise x
+		return ret
+
+	async def export(self, fn: str, outdir: str|Path, decompress=True):
+		data = await self.read(fn, decompress=False)
+		compressed = decompress and fn.endswith(".lz4") and bool(data)
+		await self._run(self.pkg._export_data, fn, data, Path(outdir), decompress, compressed)
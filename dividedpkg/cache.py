@@ -0,0 +1,192 @@
+import hashlib
+import os
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from pathlib import Path
+from threading import Lock
+
+# Bump when compress_frame's frame settings change so old blobs aren't reused
+FRAME_FORMAT = "lz4f-independent-maxblock-checksum-v1"
+
+
+def default_cache_dir():
+	if os.name == "nt":
+		base = Path(os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local")
+	else:
+		base = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+	return base / "dividedpkg"
+
+
+class CompressionCache:
+	"""
+	On-disk store of compressed, unencrypted LZ4 frames keyed by a hash of the
+	source contents and the compression settings. Once it holds more than
+	max_size bytes, the least recently used blobs are removed.
+	"""
+	def __init__(self, root: str|Path|None = None, max_size: int = 4 << 30):
+		self.root = Path(root) if root else default_cache_dir()
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._lock = Lock()
+		self._size: int|None = None
+
+	def key(self, data: bytes, level: int):
+		h = hashlib.blake2b(digest_size=20)
+		h.update(f"{FRAME_FORMAT}:{level}:".encode("ascii"))
+		h.update(data)
+		return h.hexdigest()
+
+	def _path(self, key: str):
+		return self.root / key[:2] / (key + ".lz4")
+
+	def get(self, key: str):
+		fp = self._path(key)
+		try:
+			data = fp.read_bytes()
+		except FileNotFoundError:
+			return None
+		# mtime doubles as the last use time for eviction
+		try:
+			os.utime(fp)
+		except OSError:
+			pass
+		return data
+
+	def put(self, key: str, data: bytes):
+		fp = self._path(key)
+		fp.parent.mkdir(parents=True, exist_ok=True)
+		# Write aside and move into place so readers never see part of a blob
+		tmp = fp.with_name(f"{fp.name}.{os.getpid()}.{id(data):x}.tmp")
+		tmp.write_bytes(data)
+		os.replace(tmp, fp)
+		with self._lock:
+			if self._size is not None:
+				self._size += len(data)
+			over = self._total() > self.max_size
+		if over:
+			self.evict()
+
+	def compress(self, data: bytes, level: int):
+		"""
+		compress_frame, but reusing the result from any earlier call with the
+		same data and level.
+		"""
+		key = self.key(data, level)
+		out = self.get(key)
+		with self._lock:
+			if out is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		if out is not None:
+			return out
+		from lz4fwrapper import compress_frame
+		out = compress_frame(data, level)
+		self.put(key, out)
+		return out
+
+	def compress_file(self, fp: str|Path, level: int):
+		return self.compress(Path(fp).read_bytes(), level)
+
+	def _blobs(self):
+		if not self.root.is_dir():
+			return []
+		return [x for x in self.root.glob("??/*.lz4") if x.is_file()]
+
+	def _total(self):
+		if self._size is None:
+			self._size = sum(x.stat().st_size for x in self._blobs())
+		return self._size
+
+	def evict(self, max_size: int|None = None):
+		"""
+		Remove least recently used blobs until the cache fits in max_size,
+		by default 90% of the configured limit so it doesn't happen every put.
+		"""
+		if max_size is None:
+			max_size = self.max_size * 9 // 10
+		with self._lock:
+			blobs = list[tuple[float, int, Path]]()
+			for fp in self._blobs():
+				try:
+					st = fp.stat()
+				except FileNotFoundError:
+					continue
+				blobs.append((st.st_mtime, st.st_size, fp))
+			total = sum(x[1] for x in blobs)
+			for _, size, fp in sorted(blobs):
+				if total <= max_size:
+					break
+				fp.unlink(missing_ok=True)
+				total -= size
+			self._size = total
+
+	def clear(self):
+		self.evict(0)
+
+
+class EntryCache:
+	"""
+	In-memory LRU of entry contents, limited by their total size. Anything
+	bigger than max_size on its own isn't kept at all.
+	"""
+	def __init__(self, max_size: int = 64 << 20):
+		self.max_size = max_size
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._items = OrderedDict[Hashable, bytes]()
+		self._lock = Lock()
+
+	def __len__(self):
+		return len(self._items)
+
+	def get(self, key: Hashable):
+		with self._lock:
+			data = self._items.get(key)
+			if data is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self._items.move_to_end(key)
+			return data
+
+	def put(self, key: Hashable, data: bytes):
+		with self._lock:
+			# Replacing counts only the new data, and too big still drops the old
+			old = self._items.pop(key, None)
+			if old is not None:
+				self.size -= len(old)
+			if len(data) > self.max_size:
+				return
+			self._items[key] = data
+			self.size += len(data)
+			while self.size > self.max_size:
+				_, dropped = self._items.popitem(last=False)
+				self.size -= len(dropped)
+				self.evictions += 1
+
+	def discard(self, match: Callable[[Hashable], bool]):
+		"""
+		Drop every key match returns true for.
+		"""
+		with self._lock:
+			for key in [x for x in self._items if match(x)]:
+				self.size -= len(self._items.pop(key))
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+			self.size = 0
+
+	def stats(self):
+		return {
+			"entries": len(self._items),
+			"size": self.size,
+			"max_size": self.max_size,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+		}
@@ -0,0 +1,244 @@
+"""
+Name filters shared by listing, unpacking, packing and the compression
+policy. Globs follow Path.match: a relative pattern is matched against the
+last parts of a name, part by part, so "*.txt" matches "a/b.txt" and
+"a/*.txt" matches "x/a/b.txt". Matching is case-insensitive on Windows,
+like Path.match there.
+"""
+import os
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+
+from .table import FileTable
+
+FLAGS = re.MULTILINE | (re.IGNORECASE if os.name == "nt" else 0)
+SEPARATORS = r"[/\\]" if os.name == "nt" else "/"
+# Answers remembered per set of globs before starting over
+CACHE_MAX = 1 << 16
+
+
+def parse_size(text: str):
+	"""
+	A size given on the command line, in bytes or with a K, M or G suffix.
+	"""
+	units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+	if text[-1:].upper() in units:
+		return int(float(text[:-1]) * units[text[-1:].upper()])
+	return int(text)
+
+
+def _set_regex(body: str):
+	"""
+	Regex for a [...] set with the brackets taken off, as fnmatch does it:
+	ranges going backwards are dropped and a set left empty never matches.
+	"""
+	negate = body[:1] == "!"
+	if negate:
+		body = body[1:]
+	# Split on the hyphens of ranges (not a leading one) to check each range
+	chunks = list[str]()
+	start, k = 0, 1
+	while (k := body.find("-", k)) >= 0:
+		chunks.append(body[start:k])
+		start = k + 1
+		k += 3
+	if body[start:]:
+		chunks.append(body[start:])
+	elif chunks:
+		chunks[-1] += "-"
+	for k in range(len(chunks) - 1, 0, -1):
+		if chunks[k - 1] and chunks[k] and chunks[k - 1][-1] > chunks[k][0]:
+			chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+			del chunks[k]
+	chars = "-".join(re.sub(r"([-&~|\[\]\\])", r"\\\1", x) for x in chunks)
+	if not chars:
+		return r"[^/\n]" if negate else "(?!)"
+	if negate:
+		return rf"[^/\n{chars}]"
+	if chars[0] == "^":
+		chars = "\\" + chars
+	return f"[{chars}]"
+
+
+def _part_regex(part: str):
+	"""
+	Regex for one part of a glob, as fnmatch translates it but never
+	matching a separator or newline.
+	"""
+	out = list[str]()
+	i, n = 0, len(part)
+	while i < n:
+		c = part[i]
+		i += 1
+		if c == "*":
+			while i < n and part[i] == "*":
+				i += 1
+			out.append(r"[^/\n]*")
+		elif c == "?":
+			out.append(r"[^/\n]")
+		elif c == "[":
+			j = i
+			if j < n and part[j] == "!":
+				j += 1
+			if j < n and part[j] == "]":
+				j += 1
+			while j < n and part[j] != "]":
+				j += 1
+			if j >= n:
+				out.append(r"\[")
+				continue
+			out.append(_set_regex(part[i:j]))
+			i = j + 1
+		else:
+			out.append(re.escape(c))
+	return "".join(out)
+
+
+def _glob_parts(pattern: str):
+	"""
+	Regex for the parts of a glob joined by separators, to go between
+	(?:^|/) and $.
+	"""
+	if not pattern:
+		raise ValueError("empty pattern")
+	if re.match(SEPARATORS, pattern) or os.name == "nt" and re.match(r"[A-Za-z]:", pattern):
+		# Anchored to a root or drive, which relative names never have
+		return "(?!)"
+	parts = [x for x in re.split(SEPARATORS, pattern) if x not in ("", ".")]
+	if not parts:
+		raise ValueError("empty pattern")
+	return "/".join(map(_part_regex, parts))
+
+
+def glob_regex(pattern: str):
+	"""
+	Regex source finding names pattern matches, one name per line.
+	"""
+	return rf"(?:^|/){_glob_parts(pattern)}$"
+
+
+class Globs:
+	"""
+	Several globs compiled into one regex. With substring, a pattern also
+	matches names it's part of. Answers are remembered per name.
+	"""
+	def __init__(self, patterns: Iterable[str] = (), substring=False):
+		self.patterns = list(patterns)
+		self.substring = substring
+		globs = [_glob_parts(x) for x in self.patterns]
+		texts = [re.escape(x) for x in self.patterns] if substring else []
+		self._each = [
+			re.compile(rf"(?:^|/){x}$" + (f"|{texts[i]}" if substring else ""), FLAGS)
+			for i, x in enumerate(globs)
+		]
+		# One anchor for all the globs so most positions fail at the first check
+		combined = "|".join([rf"(?:^|/)(?:{'|'.join(globs)})$"] + texts) if globs else ""
+		self._regex = re.compile(combined, FLAGS) if globs else None
+		self._bytes = re.compile(combined.encode("utf8"), FLAGS) if globs else None
+		self._cache = dict[str, bool]()
+
+	def __bool__(self):
+		return bool(self.patterns)
+
+	def __call__(self, name: str):
+		"""
+		Whether any of the globs match name.
+		"""
+		try:
+			return self._cache[name]
+		except KeyError:
+			pass
+		if len(self._cache) >= CACHE_MAX:
+			self._cache.clear()
+		ret = self._cache[name] = bool(self._regex and self._regex.search(name))
+		return ret
+
+	def first(self, name: str):
+		"""
+		Index of the first glob matching name, or -1.
+		"""
+		if not self(name):
+			return -1
+		return next(i for i, x in enumerate(self._each) if x.search(name))
+
+	def rows(self, table: FileTable):
+		"""
+		Rows of table with a matching name, in one pass over its names.
+		"""
+		if not self._bytes:
+			return list[int]()
+		return table.match(self._bytes)
+
+	def __getstate__(self):
+		# Sent to worker processes as the patterns, not a cache of answers
+		return self.patterns, self.substring
+
+	def __setstate__(self, state: tuple[list[str], bool]):
+		self.__init__(*state)
+
+
+@dataclass
+class Filter:
+	"""
+	Which entries an operation applies to: names matching any include glob
+	(or all names without any) and none of the exclude globs, optionally
+	narrowed down by size, by extension (ignoring .lz4, case-insensitive)
+	and by whether they're stored compressed. With substring, include
+	patterns also match names they're part of.
+	"""
+	include: list[str] = field(default_factory=list)
+	exclude: list[str] = field(default_factory=list)
+	min_size: int|None = None
+	max_size: int|None = None
+	extensions: list[str] = field(default_factory=list)
+	compressed: bool|None = None
+	substring: bool = False
+
+	def __post_init__(self):
+		self._include = Globs(self.include, self.substring)
+		self._exclude = Globs(self.exclude)
+		self._extensions = {"." + x.lower().lstrip(".") for x in self.extensions}
+
+	def _keep(self, name: str, size: int|None):
+		"""
+		Everything but the globs.
+		"""
+		if size is not None:
+			if self.min_size is not None and size < self.min_size:
+				return False
+			if self.max_size is not None and size > self.max_size:
+				return False
+		compressed = name.endswith(".lz4")
+		if self.compressed is not None and compressed != self.compressed:
+			return False
+		if self._extensions:
+			base = name[:-4] if compressed else name
+			dot = base.rfind(".")
+			if dot <= base.rfind("/") or base[dot:].lower() not in self._extensions:
+				return False
+		return True
+
+	def __call__(self, name: str, size: int|None = None):
+		"""
+		Whether the entry name of size (ignored if None) passes.
+		"""
+		return (
+			(not self._include or self._include(name))
+			and not self._exclude(name)
+			and self._keep(name, size)
+		)
+
+	def rows(self, table: FileTable):
+		"""
+		Rows of table that pass, in table order.
+		"""
+		rows = self._include.rows(table) if self._include else range(len(table))
+		if self._exclude:
+			excluded = set(self._exclude.rows(table))
+			rows = [x for x in rows if x not in excluded]
+		if (self.min_size is None and self.max_size is None and self.compressed is None
+			and not self._extensions
+		):
+			return list(rows)
+		return [x for x in rows if self._keep(table.name(x), table.sizes[x])]
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import struct
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+
+from .cache import default_cache_dir
+from .table import little_endian
+
+MAGIC = b"DPKI"
+VERSION = 2
+# magic, version, encrypted, pkg size, pkg mtime, entry count
+_HEADER = struct.Struct("<4sHBxQqQ")
+
+
+@dataclass
+class TableIndex:
+	"""
+	A pkg's header and file table in columns, as stored in the index. Names
+	are kept the way FileTable holds them, so loading one copies them over
+	in one go instead of name by name.
+	"""
+	format: str
+	version: str
+	encrypted: bool
+	names_blob: bytearray
+	name_starts: array
+	sizes: array
+	dummies: array
+	offsets: array
+
+	def to_bytes(self, size: int, mtime_ns: int, path: str):
+		out = bytearray(_HEADER.pack(MAGIC, VERSION, self.encrypted, size, mtime_ns,
+			len(self.sizes)))
+		for s in (path.encode("utf8"), self.format.encode("ascii"), self.version.encode("ascii")):
+			out += struct.pack("<I", len(s)) + s
+		out += little_endian(array("Q", self.offsets)).tobytes()
+		out += little_endian(array("Q", self.sizes)).tobytes()
+		out += little_endian(array("I", self.dummies)).tobytes()
+		out += little_endian(array("Q", self.name_starts)).tobytes()
+		out += self.names_blob
+		return bytes(out)
+
+	@classmethod
+	def from_bytes(cls, data: bytes, size: int, mtime_ns: int, path: str):
+		"""
+		Parse an index, or return None if it's not for this exact file or
+		is damaged.
+		"""
+		try:
+			return cls._parse(memoryview(data), size, mtime_ns, path)
+		except (struct.error, UnicodeDecodeError, ValueError):
+			return None
+
+	@classmethod
+	def _parse(cls, data: memoryview, size: int, mtime_ns: int, path: str):
+		magic, version, encrypted, isize, imtime, count = _HEADER.unpack_from(data)
+		if magic != MAGIC or version != VERSION or isize != size or imtime != mtime_ns:
+			return None
+		pos = _HEADER.size
+		strings = list[str]()
+		for _ in range(3):
+			(sz,) = struct.unpack_from("<I", data, pos)
+			strings.append(bytes(data[pos + 4:pos + 4 + sz]).decode("utf8"))
+			pos += 4 + sz
+		if strings[0] != path:
+			return None
+
+		def column(typecode: str):
+			nonlocal pos
+			arr = array(typecode)
+			end = pos + arr.itemsize * count
+			if end > len(data):
+				raise ValueError("index is truncated")
+			arr.frombytes(data[pos:end])
+			pos = end
+			return little_endian(arr)
+
+		offsets = column("Q")
+		sizes = column("Q")
+		dummies = column("I")
+		name_starts = column("Q")
+		names_blob = bytearray(data[pos:])
+		# Cheap checks that the names are laid out as FileTable expects, a
+		# full one would take longer than the rest of the load
+		if count:
+			last = name_starts[-1]
+			damaged = (name_starts[0] != 0 or last >= len(names_blob)
+				or last and names_blob[last - 1] != 10 or names_blob[-1] != 10)
+		else:
+			damaged = bool(names_blob)
+		if damaged or not names_blob.isascii():
+			raise ValueError("index names are damaged")
+		return cls(strings[1], strings[2], bool(encrypted), names_blob, name_starts, sizes,
+			dummies, offsets)
+
+
+class IndexCache:
+	"""
+	Keeps each pkg's parsed file table on disk, keyed by the pkg's path and
+	checked against its size and modification time, so loading an unchanged
+	pkg doesn't need to decrypt and parse its header again.
+	"""
+	def __init__(self, root: str|Path|None = None):
+		self.root = Path(root) if root else default_cache_dir() / "index"
+
+	def _path(self, pkg_fn: str):
+		digest = hashlib.blake2b(pkg_fn.encode("utf8"), digest_size=16).hexdigest()
+		return self.root / (digest + ".idx")
+
+	def get(self, pkg_fn: str|Path):
+		pkg_fn = str(Path(pkg_fn).resolve())
+		try:
+			st = os.stat(pkg_fn)
+			data = self._path(pkg_fn).read_bytes()
+		except FileNotFoundError:
+			return None
+		return TableIndex.from_bytes(data, st.st_size, st.st_mtime_ns, pkg_fn)
+
+	def put(self, pkg_fn: str|Path, table: TableIndex):
+		pkg_fn = str(Path(pkg_fn).resolve())
+		st = os.stat(pkg_fn)
+		fp = self._path(pkg_fn)
+		fp.parent.mkdir(parents=True, exist_ok=True)
+		tmp = fp.with_name(f"{fp.name}.{os.getpid()}.tmp")
+		tmp.write_bytes(table.to_bytes(st.st_size, st.st_mtime_ns, pkg_fn))
+		os.replace(tmp, fp)
@@ -1,72 +1,465 @@
 # distutils: language = c
 # cython: language_level=3
 
-from libc.stdlib cimport malloc, free
+import threading
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
 from libc.string cimport memset
 from libc.stdint cimport uint8_t
 from lz4f cimport *
 
-def compress_frame(bytes src, int compressionLevel):
-	cdef size_t srcSize = len(src)
+cdef extern from "lz4.h" nogil:
+	int LZ4_decompress_safe(const char* src, char* dst, int compressedSize, int dstCapacity)
+
+# Input is fed to LZ4F and output collected in pieces of this size
+CHUNK_SIZE = 4 * 1024 * 1024
+# Contexts don't hang on to scratch buffers bigger than this
+SCRATCH_MAX = 16 * 1024 * 1024
+
+cdef int check(size_t code) except -1:
+	if LZ4F_isError(code):
+		msg = LZ4F_getErrorName(code)
+		raise RuntimeError(f"LZ4 error: {msg.decode()}")
+	return 0
+
+cdef LZ4F_preferences_t frame_prefs(int compressionLevel, unsigned long long contentSize):
 	cdef LZ4F_preferences_t prefs
 	memset(&prefs, 0, sizeof(LZ4F_preferences_t))
 	prefs.frameInfo.blockMode = LZ4F_blockIndependent
-	prefs.frameInfo.blockSizeID = LZ4F_max4MB
+	# Smallest block size that fits, as LZ4F_compressFrame would pick, so
+	# streamed and one-shot compression produce the same frame
+	if contentSize and contentSize <= 64 * 1024:
+		prefs.frameInfo.blockSizeID = LZ4F_max64KB
+	elif contentSize and contentSize <= 256 * 1024:
+		prefs.frameInfo.blockSizeID = LZ4F_max256KB
+	elif contentSize and contentSize <= 1024 * 1024:
+		prefs.frameInfo.blockSizeID = LZ4F_max1MB
+	else:
+		prefs.frameInfo.blockSizeID = LZ4F_max4MB
 	prefs.frameInfo.contentChecksumFlag = LZ4F_contentChecksumEnabled
-	prefs.frameInfo.contentSize = srcSize
+	prefs.frameInfo.contentSize = contentSize
 	prefs.compressionLevel = compressionLevel
 	prefs.favorDecSpeed = 1
-	cdef size_t dstCap = LZ4F_compressFrameBound(srcSize, &prefs)
-	cdef char* dst = <char*> malloc(dstCap)
-	if not dst:
-		raise MemoryError()
-
-	cdef const uint8_t[:] src_view = src
-	cdef size_t result = LZ4F_compressFrame(dst, dstCap, <const void*> &src_view[0], srcSize, &prefs)
-	if LZ4F_isError(result):
-		msg = LZ4F_getErrorName(result)
-		free(dst)
-		raise RuntimeError(f"LZ4 error: {msg.decode()}")
+	return prefs
+
+cdef class Context:
+	"""
+	LZ4F compression and decompression state plus a grow-only scratch
+	buffer, kept between calls to save setting them up for every frame.
+	Each thread has its own, see context(). A stream holds its context
+	until it's closed, anything else on that thread meanwhile gets a
+	temporary one.
+	"""
+	cdef LZ4F_cctx* cctx
+	cdef LZ4F_dctx* dctx
+	cdef bytearray scratch
+	cdef bint busy
+
+	def __cinit__(self):
+		check(LZ4F_createCompressionContext(&self.cctx, LZ4F_VERSION))
+		check(LZ4F_createDecompressionContext(&self.dctx, LZ4F_VERSION))
+		self.scratch = bytearray()
+
+	def __dealloc__(self):
+		if self.cctx:
+			LZ4F_freeCompressionContext(self.cctx)
+		if self.dctx:
+			LZ4F_freeDecompressionContext(self.dctx)
+
+	cdef bytearray buffer(self, size_t size):
+		"""
+		Scratch space of at least size bytes, only valid until the next call.
+		"""
+		if <size_t> len(self.scratch) >= size:
+			return self.scratch
+		if size > <size_t> SCRATCH_MAX:
+			return bytearray(size)
+		# Replace rather than resize, the old one may still be exported
+		self.scratch = bytearray(size)
+		return self.scratch
+
+	def compress(self, const uint8_t[:] src, int compressionLevel):
+		cdef size_t srcSize = len(src)
+		cdef LZ4F_preferences_t prefs = frame_prefs(compressionLevel, srcSize)
+		cdef size_t dstCap = LZ4F_compressFrameBound(srcSize, &prefs)
+		cdef bytearray buf = self.buffer(dstCap)
+		cdef char* dst = buf
+		cdef const void* src_ptr = <const void*> &src[0] if srcSize else NULL
+		cdef size_t result
+		with nogil:
+			result = LZ4F_compressFrame_usingCDict(self.cctx, dst, dstCap, src_ptr, srcSize,
+				NULL, &prefs)
+		check(result)
+		return PyBytes_FromStringAndSize(dst, result)
+
+	def decompress(self, const uint8_t[:] src):
+		cdef size_t srcSize = len(src)
+		if not srcSize:
+			raise RuntimeError("LZ4 error: truncated frame")
+		LZ4F_resetDecompressionContext(self.dctx)
+		cdef const uint8_t* src_ptr = &src[0]
+		cdef LZ4F_frameInfo_t info
+		cdef size_t pos = srcSize
+		check(LZ4F_getFrameInfo(self.dctx, &info, src_ptr, &pos))
+
+		cdef size_t srcLeft, dstSize, hint = 1
+		cdef size_t done = 0
+		cdef bytes out
+		cdef bytearray buf
+		cdef char* dst
+		if info.contentSize:
+			# Straight into the result
+			out = PyBytes_FromStringAndSize(NULL, info.contentSize)
+			dst = PyBytes_AS_STRING(out)
+			srcLeft = srcSize - pos
+			dstSize = info.contentSize
+			with nogil:
+				hint = LZ4F_decompress(self.dctx, dst, &dstSize, src_ptr + pos, &srcLeft, NULL)
+			check(hint)
+			pos += srcLeft
+			done = dstSize
+		else:
+			# Into scratch, growing it as needed
+			buf = self.buffer(max(srcSize * 4, <size_t> 64 * 1024))
+			while hint:
+				if done == <size_t> len(buf):
+					buf = buf + bytearray(len(buf))
+				dst = buf
+				srcLeft = srcSize - pos
+				dstSize = len(buf) - done
+				with nogil:
+					hint = LZ4F_decompress(self.dctx, dst + done, &dstSize, src_ptr + pos, &srcLeft, NULL)
+				check(hint)
+				pos += srcLeft
+				done += dstSize
+				if pos == srcSize and done < <size_t> len(buf):
+					# Out of input with nothing held back
+					break
+			if len(buf) > SCRATCH_MAX:
+				self.scratch = bytearray()
+			out = PyBytes_FromStringAndSize(<char*> buf, done)
+		if hint:
+			raise RuntimeError("LZ4 error: truncated frame")
+		if pos < srcSize:
+			raise RuntimeError("LZ4 error: data after end of frame")
+		return out
 
-	out = bytes(dst[:result])
-	free(dst)
+	def verify(self, const uint8_t[:] src):
+		"""
+		Decode a frame without keeping the output, so its block and content
+		checksums (if it has them) and content size get checked. Returns the
+		decompressed size.
+		"""
+		cdef size_t srcSize = len(src)
+		if not srcSize:
+			raise RuntimeError("LZ4 error: truncated frame")
+		LZ4F_resetDecompressionContext(self.dctx)
+		cdef bytearray buf = self.buffer(CHUNK_SIZE)
+		cdef char* dst = buf
+		cdef size_t dstCap = len(buf)
+		cdef const uint8_t* src_ptr = &src[0]
+		cdef size_t pos = 0, srcLeft, dstSize, hint = 1
+		cdef unsigned long long done = 0
+		with nogil:
+			while hint:
+				srcLeft = srcSize - pos
+				dstSize = dstCap
+				hint = LZ4F_decompress(self.dctx, dst, &dstSize, src_ptr + pos, &srcLeft, NULL)
+				if LZ4F_isError(hint):
+					break
+				pos += srcLeft
+				done += dstSize
+				if pos == srcSize and dstSize < dstCap:
+					break
+		check(hint)
+		if hint:
+			raise RuntimeError("LZ4 error: truncated frame")
+		if pos < srcSize:
+			raise RuntimeError("LZ4 error: data after end of frame")
+		return done
+
+
+_local = threading.local()
+
+cpdef Context context():
+	"""
+	This thread's Context, or a new one if it's being used by a stream.
+	"""
+	cdef Context ctx = getattr(_local, "context", None)
+	if ctx is None:
+		ctx = _local.context = Context()
+	elif ctx.busy:
+		return Context()
+	return ctx
+
+def compress_frame(const uint8_t[:] src, int compressionLevel):
+	return context().compress(src, compressionLevel)
+
+def decompress_frame(const uint8_t[:] src):
+	return context().decompress(src)
+
+def verify_frame(const uint8_t[:] src):
+	return context().verify(src)
+
+def decompress_block(const uint8_t[:] src, int maxSize):
+	"""
+	Decompress a single block from inside a frame (without its size or
+	checksum), which must not depend on earlier blocks.
+	"""
+	out = bytearray(maxSize)
+	cdef char* dst = out
+	cdef int srcSize = len(src)
+	cdef const char* src_ptr = <const char*> &src[0] if srcSize else NULL
+	cdef int size
+	with nogil:
+		size = LZ4_decompress_safe(src_ptr, dst, srcSize, maxSize)
+	if size < 0:
+		raise RuntimeError("LZ4 error: corrupt block")
+	del out[size:]
 	return out
 
-def decompress_frame(bytes src):
+def block_content_size(const uint8_t[:] src):
+	"""
+	Size a single block from inside a frame decompresses to, found by
+	walking its sequences without decoding them.
+	"""
+	cdef size_t srcSize = len(src)
+	cdef const uint8_t* p = &src[0] if srcSize else NULL
+	cdef size_t pos = 0
+	cdef size_t size = 0
+	cdef size_t n
+	cdef uint8_t token, b
+	cdef bint bad = False
+	with nogil:
+		while pos < srcSize:
+			token = p[pos]
+			pos += 1
+			# Literals, with 15 meaning more length bytes follow
+			n = token >> 4
+			if n == 15:
+				b = 255
+				while b == 255 and pos < srcSize:
+					b = p[pos]
+					pos += 1
+					n += b
+			pos += n
+			size += n
+			if pos >= srcSize:
+				# The last sequence is only literals
+				bad = pos > srcSize
+				break
+			# Match offset, then its length past the minimum of 4
+			pos += 2
+			n = token & 15
+			if n == 15:
+				b = 255
+				while b == 255 and pos < srcSize:
+					b = p[pos]
+					pos += 1
+					n += b
+			size += n + 4
+			if pos >= srcSize:
+				bad = True
+				break
+	if bad:
+		raise RuntimeError("LZ4 error: corrupt block")
+	return size
+
+
+cdef class FrameCompressor:
+	"""
+	Incrementally compress into an LZ4 frame, in the same format as
+	compress_frame, writing the result to a file-like sink.
+	The sink must be done with each buffer when its write returns.
+	"""
+	cdef Context context
+	cdef bint holding
+	cdef LZ4F_cctx* ctx
+	cdef LZ4F_preferences_t prefs
+	cdef bytearray buf
+	cdef uint8_t[::1] dst
+	cdef bint started
+	cdef readonly object sink
+	cdef readonly bint closed
+	cdef readonly unsigned long long bytes_in
+	cdef readonly unsigned long long bytes_out
+
+	def __cinit__(self, sink, int compressionLevel, unsigned long long contentSize=0):
+		self.context = context()
+		self.context.busy = self.holding = True
+		self.ctx = self.context.cctx
+		self.prefs = frame_prefs(compressionLevel, contentSize)
+		self.buf = self.context.buffer(
+			max(LZ4F_compressBound(CHUNK_SIZE, &self.prefs), LZ4F_HEADER_SIZE_MAX))
+		self.dst = self.buf
+		self.sink = sink
+
+	def __dealloc__(self):
+		self.release()
+
+	cdef release(self):
+		if self.holding:
+			self.context.busy = self.holding = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *_):
+		if exc_type is None:
+			self.close()
+
+	cdef emit(self, size_t size):
+		if size:
+			self.sink.write(memoryview(self.buf)[:size])
+			self.bytes_out += size
+
+	cdef begin(self):
+		cdef size_t size = LZ4F_compressBegin(self.ctx, &self.dst[0], len(self.dst), &self.prefs)
+		check(size)
+		self.started = True
+		self.emit(size)
+
+	def write(self, const uint8_t[:] data):
+		if self.closed:
+			raise ValueError("write to closed FrameCompressor")
+		if not self.started:
+			self.begin()
+
+		cdef size_t total = len(data)
+		cdef size_t pos = 0
+		cdef size_t n, size
+		cdef size_t dstCap = len(self.dst)
+		while pos < total:
+			n = min(total - pos, <size_t> CHUNK_SIZE)
+			with nogil:
+				size = LZ4F_compressUpdate(self.ctx, &self.dst[0], dstCap, &data[pos], n, NULL)
+			check(size)
+			self.emit(size)
+			pos += n
+		self.bytes_in += total
+		return total
+
+	def flush(self):
+		"""
+		Write out anything LZ4F is holding on to, ending the current block.
+		"""
+		if self.closed or not self.started:
+			return
+		cdef size_t size = LZ4F_flush(self.ctx, &self.dst[0], len(self.dst), NULL)
+		check(size)
+		self.emit(size)
+
+	def close(self):
+		"""
+		End the frame. The sink is left open.
+		"""
+		if self.closed:
+			return
+		if not self.started:
+			self.begin()
+		cdef size_t size = LZ4F_compressEnd(self.ctx, &self.dst[0], len(self.dst), NULL)
+		check(size)
+		self.emit(size)
+		self.closed = True
+		self.release()
+
+
+cdef class FrameDecompressor:
+	"""
+	Incrementally decompress an LZ4 frame fed to it in chunks of any size,
+	writing the result to a file-like sink.
+	The sink must be done with each buffer when its write returns.
+	"""
+	cdef Context context
+	cdef bint holding
 	cdef LZ4F_dctx* ctx
-	cdef LZ4F_errorCode_t err = LZ4F_createDecompressionContext(&ctx, LZ4F_VERSION)
-	if LZ4F_isError(err):
-		msg = LZ4F_getErrorName(err)
-		raise RuntimeError(f"failed to create decompression ctx {msg.decode()}")
+	cdef bytearray buf
+	cdef uint8_t[::1] dst
+	cdef readonly object sink
+	cdef readonly bint eof
+	cdef readonly unsigned long long bytes_in
+	cdef readonly unsigned long long bytes_out
 
-	cdef size_t srcSize = len(src)
-	cdef size_t srcRead = srcSize
-	cdef const uint8_t[:] cSrc = src
-	cdef const uint8_t *src_view = &cSrc[0]
-	cdef LZ4F_frameInfo_t info
-	LZ4F_getFrameInfo(ctx, &info, <const void*> src_view, &srcRead)
-	src_view += srcRead
-	srcSize -= srcRead
-
-	cdef LZ4F_decompressOptions_t opts
-	memset(&opts, 0, sizeof(LZ4F_decompressOptions_t))
-
-	cdef size_t dstSize = info.contentSize
-	cdef size_t dstWritten
-	cdef char *dst = <char*> malloc(dstSize)
-	if not dst:
-		raise RuntimeError("failed to allocate destination memory")
-
-	out = b""
-	cdef char *dst_view = dst
-	while srcSize:
-		srcRead = srcSize
-		dstWritten = dstSize
-		LZ4F_decompress(ctx, <void*> dst_view, &dstWritten, <const void*> src_view, &srcRead, &opts)
-		dst_view += dstWritten
-		src_view += srcRead
-		srcSize -= srcRead
-
-	out = bytes(dst[:dstSize])
-	free(dst)
-	return out
+	def __cinit__(self, sink):
+		self.context = context()
+		self.context.busy = self.holding = True
+		self.ctx = self.context.dctx
+		LZ4F_resetDecompressionContext(self.ctx)
+		self.buf = self.context.buffer(CHUNK_SIZE)
+		self.dst = self.buf
+		self.sink = sink
+
+	def __dealloc__(self):
+		self.release()
+
+	cdef release(self):
+		if self.holding:
+			self.context.busy = self.holding = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *_):
+		if exc_type is None:
+			self.close()
+
+	def write(self, const uint8_t[:] data):
+		cdef size_t total = len(data)
+		if not total:
+			return 0
+		if self.eof:
+			raise RuntimeError("LZ4 error: data after end of frame")
+
+		cdef const uint8_t* src = &data[0]
+		cdef size_t pos = 0
+		cdef size_t srcSize
+		cdef size_t dstSize = 0
+		cdef size_t dstCap = len(self.dst)
+		cdef size_t hint
+		# Keep going while there's input or the last call filled the output
+		while pos < total or dstSize == dstCap:
+			srcSize = total - pos
+			dstSize = dstCap
+			with nogil:
+				hint = LZ4F_decompress(self.ctx, &self.dst[0], &dstSize, src + pos, &srcSize, NULL)
+			check(hint)
+			pos += srcSize
+			if dstSize:
+				self.sink.write(memoryview(self.buf)[:dstSize])
+				self.bytes_out += dstSize
+			if hint == 0:
+				self.eof = True
+				self.release()
+				break
+		self.bytes_in += pos
+		if pos < total:
+			raise RuntimeError("LZ4 error: data after end of frame")
+		return total
+
+	def close(self):
+		"""
+		Check the whole frame was seen. The sink is left open.
+		"""
+		if not self.eof:
+			raise RuntimeError("LZ4 error: truncated frame")
+
+
+def compress_stream(src, dst, int compressionLevel, unsigned long long contentSize=0):
+	"""
+	Compress everything read from src into a frame written to dst.
+	Returns the compressed size.
+	"""
+	cdef FrameCompressor comp = FrameCompressor(dst, compressionLevel, contentSize)
+	while chunk := src.read(CHUNK_SIZE):
+		comp.write(chunk)
+	comp.close()
+	return comp.bytes_out
+
+def decompress_stream(src, dst):
+	"""
+	Decompress a frame read from src into dst. Returns the decompressed size.
+	"""
+	cdef FrameDecompressor dec = FrameDecompressor(dst)
+	while chunk := src.read(CHUNK_SIZE):
+		dec.write(chunk)
+	dec.close()
+	return dec.bytes_out
@@ -1,6 +1,7 @@
-cdef extern from "lz4frame.h":
+cdef extern from "lz4frame.h" nogil:
 
     cdef unsigned LZ4F_VERSION = 100
+    cdef size_t LZ4F_HEADER_SIZE_MAX = 19
     ctypedef size_t LZ4F_errorCode_t
 
     # Opaque structs
@@ -79,12 +80,21 @@ cdef extern from "lz4frame.h":
     size_t LZ4F_compressFrameBound(size_t srcSize,
                                    const LZ4F_preferences_t* prefs)
 
+    size_t LZ4F_compressBound(size_t srcSize,
+                              const LZ4F_preferences_t* prefs)
+
     int LZ4F_compressionLevel_max()
 
     LZ4F_errorCode_t LZ4F_createCompressionContext(LZ4F_cctx** cctx, unsigned version)
     LZ4F_errorCode_t LZ4F_freeCompressionContext(LZ4F_cctx* cctx)
     LZ4F_errorCode_t LZ4F_createDecompressionContext(LZ4F_dctx** dctxPtr, unsigned version)
     LZ4F_errorCode_t LZ4F_freeDecompressionContext(LZ4F_dctx* dctx)
+    void LZ4F_resetDecompressionContext(LZ4F_dctx* dctx)
+
+    size_t LZ4F_compressFrame_usingCDict(LZ4F_cctx* cctx, void* dst, size_t dstCapacity,
+                                         const void* src, size_t srcSize,
+                                         const LZ4F_CDict* cdict,
+                                         const LZ4F_preferences_t* prefs)
 
     size_t LZ4F_compressBegin(LZ4F_cctx* cctx, void* dst, size_t dstCap,
                               const LZ4F_preferences_t* prefs)
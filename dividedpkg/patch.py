@@ -0,0 +1,152 @@
+"""
+Patches between two versions of a pkg. A patch holds the new file table
+and the stored bytes of only the entries that changed; everything else is
+copied from the old pkg when the patch is applied.
+"""
+import hashlib
+import struct
+from array import array
+from pathlib import Path
+from typing import BinaryIO
+
+from . import CHUNK_SIZE, PKG
+from .table import little_endian
+from .writer import PKGWriter
+
+MAGIC = b"DPKP"
+VERSION = 1
+# magic, version, encrypted, entry count, base entry count, base table digest
+_HEADER = struct.Struct("<4sHBxQQ16s")
+DIGEST_SIZE = 16
+
+
+def table_digest(pkg: PKG):
+	"""
+	Hash of a pkg's names and sizes, to tell which pkg a patch is for.
+	"""
+	h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+	for entry in pkg.files.values():
+		h.update(entry.name.encode("ascii") + b"\n" + entry.size.to_bytes(8, "little"))
+	return h.digest()
+
+
+def entry_digest(pkg: PKG, name: str):
+	"""
+	Hash of an entry's stored bytes, decrypted but not decompressed.
+	"""
+	h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+	with pkg.open(name, decompress=False) as f:
+		while chunk := f.read(CHUNK_SIZE):
+			h.update(chunk)
+	return h.digest()
+
+
+class _Part:
+	"""
+	Reads size bytes of f from where it is.
+	"""
+	def __init__(self, f: BinaryIO, size: int):
+		self.f = f
+		self.left = size
+
+	def read(self, size=-1):
+		size = self.left if size < 0 else min(size, self.left)
+		data = self.f.read(size)
+		if len(data) < size:
+			raise EOFError(f"{self.f.name} ended {size - len(data)} bytes early")
+		self.left -= len(data)
+		return data
+
+
+def diff(base: PKG, target: PKG, out: str|Path):
+	"""
+	Write a patch turning base into target. Entries are compared by name,
+	and only hashed when their sizes match. Returns how many entries are
+	reused from base and how many are in the patch.
+	"""
+	base_rows = {x: i for i, x in enumerate(base.files.names())}
+	names = target.files.names()
+	sources = array("q")
+	digests = list[bytes]()
+	for name in names:
+		entry = target.files[name]
+		digest = entry_digest(target, name)
+		row = base_rows.get(name, -1)
+		if row >= 0 and base.files[name].size == entry.size and entry_digest(base, name) == digest:
+			sources.append(row)
+		else:
+			sources.append(-1)
+		digests.append(digest)
+
+	encoded = [x.encode("ascii") for x in names]
+	with Path(out).open("wb") as f:
+		f.write(_HEADER.pack(MAGIC, VERSION, bool(target.encrypted), len(names),
+			len(base.files), table_digest(base)))
+		for s in (target.format, target.version):
+			f.write(struct.pack("<I", len(s)) + s.encode("ascii"))
+		f.write(little_endian(array("Q", (target.files[x].size for x in names))).tobytes())
+		f.write(little_endian(array("I", (target.files[x].dummy for x in names))).tobytes())
+		f.write(little_endian(sources).tobytes())
+		f.write(little_endian(array("I", map(len, encoded))).tobytes())
+		f.write(b"".join(encoded))
+		for name, source in zip(names, sources):
+			if source < 0:
+				with target.open(name, decompress=False) as src:
+					while chunk := src.read(CHUNK_SIZE):
+						f.write(chunk)
+		f.write(b"".join(digests))
+	changed = sources.tolist().count(-1)
+	return len(names) - changed, changed
+
+
+def apply(base: PKG, patch: str|Path, out: str|Path, verify=False):
+	"""
+	Build the pkg a patch describes at out, copying unchanged entries from
+	base. With verify, every entry written is checked against the hash it
+	had when the patch was made. Returns the new pkg.
+	"""
+	if base.filename and Path(out).resolve() == base.filename.resolve():
+		raise ValueError("can't write a patched pkg over the one it's based on")
+	with Path(patch).open("rb") as f:
+		header = f.read(_HEADER.size)
+		if len(header) < _HEADER.size:
+			raise ValueError(f"{patch} is not a pkg patch")
+		magic, version, encrypted, count, base_count, base_digest = _HEADER.unpack(header)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(f"{patch} is not a pkg patch")
+		if base_count != len(base.files) or base_digest != table_digest(base):
+			raise ValueError(f"{patch} is for a different version of {base.filename}")
+		strings = list[str]()
+		for _ in range(2):
+			(sz,) = struct.unpack("<I", f.read(4))
+			strings.append(f.read(sz).decode("ascii"))
+
+		def column(typecode: str):
+			arr = array(typecode)
+			arr.frombytes(f.read(arr.itemsize * count))
+			return little_endian(arr)
+
+		sizes = column("Q")
+		dummies = column("I")
+		sources = column("q")
+		names = [f.read(sz).decode("ascii") for sz in column("I")]
+		base_names = base.files.names()
+
+		with PKGWriter(out, encrypt=bool(encrypted), names=names) as writer:
+			writer.pkg.format, writer.pkg.version = strings
+			for name, size, dummy, source in zip(names, sizes, dummies, sources):
+				if source >= 0:
+					writer.copy(base, base_names[source], name)
+				else:
+					writer.add(name, _Part(f, size))
+				writer.pkg.files[name].dummy = dummy
+		digests = f.read(DIGEST_SIZE * count)
+
+	ret = writer.pkg
+	if verify:
+		bad = [x for i, x in enumerate(names)
+			if entry_digest(ret, x) != digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]]
+		ret.close()
+		if bad:
+			raise ValueError(f"{len(bad)} entries don't match the patch, first is {bad[0]}")
+	return ret
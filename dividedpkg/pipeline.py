@@ -0,0 +1,271 @@
+import os
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import Condition
+from typing import TypeVar
+
+from . import PKG, get_key, stats, xor_buffer
+from .filters import Filter
+from .index import IndexCache
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Writing is disk bound, a couple of threads is enough to keep it busy
+WRITERS = 2
+
+
+def get_jobs(jobs: int):
+	"""
+	Resolve a worker count, 0 or less meaning one per CPU.
+	"""
+	return jobs if jobs > 0 else (os.cpu_count() or 1)
+
+
+class ByteBudget:
+	"""
+	Limits how many bytes are in flight between pipeline stages.
+	A single item larger than the limit is still let through on its own.
+	"""
+	def __init__(self, limit: int):
+		self.limit = limit
+		self.used = 0
+		self._cond = Condition()
+
+	def acquire(self, size: int):
+		with self._cond:
+			while self.used and self.used + size > self.limit:
+				self._cond.wait()
+			self.used += size
+
+	def resize(self, old: int, new: int):
+		"""
+		Change the size of something already acquired without blocking.
+		"""
+		with self._cond:
+			self.used += new - old
+			if new < old:
+				self._cond.notify_all()
+		return new
+
+	def release(self, size: int):
+		with self._cond:
+			self.used -= size
+			self._cond.notify_all()
+
+
+def export_parallel(pkg: PKG, names: list[str], outdir: str, *,
+	decompress=True, jobs=0, memory_limit=256 << 20,
+):
+	"""
+	Export the given entries with reads, decrypt/decompress and writes all
+	overlapping. The calling thread reads ahead of the workers as long as
+	fewer than memory_limit bytes are waiting to be written.
+	"""
+	key = get_key()
+	budget = ByteBudget(memory_limit)
+	errors = list[BaseException]()
+
+	def write(fn: str, data: bytes|bytearray, cost: int):
+		try:
+			pkg._export_data(fn, data, outdir, decompress)
+		except BaseException as err:
+			errors.append(err)
+			raise
+		finally:
+			budget.release(cost)
+
+	def work(fn: str, data: bytearray, offset: int|None):
+		cost = len(data)
+		try:
+			if pkg.encrypted and offset is not None:
+				t = stats.clock()
+				xor_buffer(data, key, offset)
+				stats.emit("xor", fn, t, len(data))
+			if decompress and fn.endswith(".lz4") and data:
+				from lz4fwrapper import decompress_frame
+				t = stats.clock()
+				data = decompress_frame(data)
+				stats.emit("decompress", fn, t, len(data))
+				cost = budget.resize(cost, len(data))
+		except BaseException as err:
+			budget.release(cost)
+			errors.append(err)
+			raise
+		return writers.submit(write, fn, data, cost)
+
+	with (
+		ThreadPoolExecutor(get_jobs(jobs), "unpack") as workers,
+		ThreadPoolExecutor(WRITERS, "write") as writers,
+	):
+		pending = list[Future]()
+		for fn in names:
+			if errors:
+				break
+			entry = pkg.files[fn]
+			budget.acquire(entry.size)
+			if entry.data:
+				# Already decrypted
+				data, offset = bytearray(entry.data), None
+			else:
+				t = stats.clock()
+				data, offset = bytearray(pkg.view(fn)), entry.offset
+				stats.emit("read", fn, t, len(data))
+			pending.append(workers.submit(work, fn, data, offset))
+
+		for future in pending:
+			if not future.exception():
+				future.result().exception()
+
+	if errors:
+		raise errors[0]
+	return len(pending)
+
+
+def ordered_map(func: Callable[[T], R], items: Iterable[T], *,
+	jobs=0, cost: Callable[[T], int]|None = None, memory_limit=256 << 20,
+) -> Iterator[tuple[T, R]]:
+	"""
+	Lazily run func over items on a thread pool, yielding (item, result) in
+	the original order. Items are only submitted as far ahead of the consumer
+	as memory_limit allows, going by what cost says each one will take.
+	"""
+	pending = deque[tuple[T, Future[R], int]]()
+	in_flight = 0
+	with ThreadPoolExecutor(get_jobs(jobs), "map") as pool:
+		for item in items:
+			size = cost(item) if cost else 0
+			while pending and in_flight + size > memory_limit:
+				done, future, done_size = pending.popleft()
+				in_flight -= done_size
+				yield done, future.result()
+			pending.append((item, pool.submit(func, item), size))
+			in_flight += size
+
+		while pending:
+			done, future, _ = pending.popleft()
+			yield done, future.result()
+
+
+def scan(root: Path, jobs=0) -> Iterator[tuple[Path, int]]:
+	"""
+	Files under root with their sizes, in the order Path.walk finds them.
+	Folders are listed and their files stat'ed on a thread pool ahead of
+	the consumer, so the waits on network or cold disks overlap.
+	Folders that can't be listed are skipped, like Path.walk does, but a
+	file that can't be stat'ed (such as a dangling symlink) is an error.
+	"""
+	def list_dir(path: str):
+		files = list[tuple[Path, int]]()
+		dirs = list[str]()
+		try:
+			it = os.scandir(path)
+		except OSError:
+			return files, dirs
+		with it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					dirs.append(entry.path)
+				else:
+					files.append((Path(entry.path), entry.stat().st_size))
+		return files, dirs
+
+	with ThreadPoolExecutor(get_jobs(jobs), "scan") as pool:
+		stack = [pool.submit(list_dir, str(root))]
+		while stack:
+			files, dirs = stack.pop().result()
+			yield from files
+			# Depth first with subfolders in listing order, as Path.walk goes
+			stack += [pool.submit(list_dir, x) for x in reversed(dirs)]
+
+
+# Work on several pkgs at once, in processes. These run in the workers so
+# they take file names rather than PKGs.
+
+def list_pkg(pkg_fn: Path, filter: Filter,
+	encrypted: bool|None = None, index: IndexCache|None = None,
+):
+	"""
+	The -l listing of a pkg as lines of text.
+	"""
+	return listing(PKG.load(pkg_fn, encrypted=encrypted, index=index), filter)
+
+
+def listing(pkg: PKG, filter: Filter):
+	lines = [f"{'offset':18s}, {'size':10s}, name"]
+	for row in filter.rows(pkg.files):
+		entry = pkg.files.entry(row)
+		lines.append(f"0x{entry.offset:016x}, 0x{entry.size:08x}, {entry.name}")
+	return lines
+
+
+def split(items: list[T], sizes: list[int], target: int):
+	"""
+	Cut items into runs of about target total size, keeping their order.
+	Always at least one run, even if empty.
+	"""
+	runs = [list[T]()]
+	total = 0
+	for item, size in zip(items, sizes):
+		if total >= target:
+			runs.append([])
+			total = 0
+		runs[-1].append(item)
+		total += size
+	return runs
+
+
+def _unpack_part(pkg_fn: Path, names: list[str], outdir: Path, decompress: bool,
+	encrypted: bool|None, index: IndexCache|None, with_stats: bool,
+):
+	collected = stats.Stats().start() if with_stats else None
+	try:
+		pkg = PKG.load(pkg_fn, encrypted=encrypted, index=index)
+		with pkg:
+			count = pkg.export_many(names, outdir, decompress=decompress)
+	finally:
+		if collected:
+			collected.stop()
+	return count, collected.stages if collected else None
+
+
+def unpack_many(pkgs: list[tuple[Path, Path]], filter: Filter, *,
+	decompress=True, processes=0, encrypted: bool|None = None,
+	index: IndexCache|None = None,
+) -> Iterator[tuple[Path, int]]:
+	"""
+	Unpack each (pkg, outdir) on a pool of processes (0 for one per CPU),
+	yielding each pkg and how many files came out of it in the given order.
+	Pkgs are split into parts of roughly equal size so a single big pkg
+	doesn't hold everything up. Stats from the workers are added to any
+	Stats hooks in this process.
+	"""
+	from concurrent.futures import ProcessPoolExecutor
+	processes = get_jobs(processes)
+	parts = list[tuple[list[str], list[int]]]()
+	for pkg_fn, _ in pkgs:
+		pkg = PKG.load(pkg_fn, encrypted=encrypted, index=index)
+		names = pkg.select(filter=filter)
+		parts.append((names, [pkg.files[x].size for x in names]))
+	# A few parts per process so they even out
+	target = max(sum(sum(x[1]) for x in parts) // (processes * 4), 1)
+	hooks = [x for x in stats.hooks if isinstance(x, stats.Stats)]
+
+	with ProcessPoolExecutor(processes) as pool:
+		pending = list[list[Future]]()
+		for (pkg_fn, outdir), (names, sizes) in zip(pkgs, parts):
+			pending.append([
+				pool.submit(_unpack_part, pkg_fn, chunk, outdir, decompress,
+					encrypted, index, bool(hooks))
+				for chunk in split(names, sizes, target)
+			])
+		for (pkg_fn, _), futures in zip(pkgs, pending):
+			total = 0
+			for future in futures:
+				count, stages = future.result()
+				total += count
+				for hook in hooks:
+					hook.merge(stages)
+			yield pkg_fn, total
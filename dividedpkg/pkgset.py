@@ -0,0 +1,118 @@
+import re
+from bisect import bisect_left
+from pathlib import Path
+
+from . import PKG, READ_CACHE_SIZE
+from .cache import EntryCache
+from .filters import Globs
+from .index import IndexCache
+
+
+def pkg_order(fp: Path):
+	"""
+	Sort key for pkg file names comparing numbers by value, so data_2.pkg
+	comes before data_10.pkg.
+	"""
+	return [int(x) if x.isdigit() else x for x in re.split(r"(\d+)", fp.name)]
+
+
+class PKGSet:
+	"""
+	Several pkgs behind one name index. When more than one pkg has the same
+	name, the last one in the list wins, so later pkgs override earlier ones.
+	"""
+	def __init__(self, pkgs: list[PKG]):
+		self.pkgs = pkgs
+		self._where = dict[str, int]()
+		for i, pkg in enumerate(pkgs):
+			for name in pkg.files.names():
+				self._where[name] = i
+		self._sorted: list[str]|None = None
+
+	@classmethod
+	def load(cls, root: str|Path, pattern="*.pkg", encrypted: bool|None = None,
+		index: IndexCache|None = None, cache: EntryCache|None = None,
+	):
+		"""
+		Load every pkg in root matching pattern, in pkg_order. They share one
+		read cache.
+		"""
+		fns = sorted((x for x in Path(root).glob(pattern) if x.is_file()), key=pkg_order)
+		cache = cache or EntryCache(READ_CACHE_SIZE)
+		pkgs = list[PKG]()
+		for fn in fns:
+			pkg = PKG.load(fn, encrypted=encrypted, index=index)
+			pkg.cache = cache
+			pkgs.append(pkg)
+		return cls(pkgs)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *_):
+		self.close()
+
+	def close(self):
+		for pkg in self.pkgs:
+			pkg.close()
+
+	def __len__(self):
+		return len(self._where)
+
+	def __contains__(self, name: object):
+		return name in self._where
+
+	def __iter__(self):
+		return iter(self.names())
+
+	def names(self):
+		"""
+		Every name across all pkgs, sorted.
+		"""
+		if self._sorted is None:
+			self._sorted = sorted(self._where)
+		return self._sorted
+
+	def locate(self, name: str):
+		"""
+		The pkg that provides name and its entry there.
+		"""
+		if name not in self._where:
+			raise KeyError(f"{name} not in any pkg")
+		pkg = self.pkgs[self._where[name]]
+		return pkg, pkg.files[name]
+
+	def providers(self, name: str):
+		"""
+		Every pkg that has name, overridden ones first.
+		"""
+		return [x for x in self.pkgs if name in x.files]
+
+	def prefix(self, prefix: str):
+		names = self.names()
+		ret = list[str]()
+		for i in range(bisect_left(names, prefix), len(names)):
+			if not names[i].startswith(prefix):
+				break
+			ret.append(names[i])
+		return ret
+
+	def glob(self, pattern: str):
+		"""
+		Names matching pattern, sorted, with the same rules as PKG.select
+		(see filters).
+		"""
+		match = Globs([pattern])
+		return [x for x in self.names() if match(x)]
+
+	def read(self, name: str, decompress=True):
+		pkg, _ = self.locate(name)
+		return pkg.read(name, decompress)
+
+	def open(self, name: str, decompress=True):
+		pkg, _ = self.locate(name)
+		return pkg.open(name, decompress)
+
+	def export(self, name: str, outdir: str|Path, decompress=True):
+		pkg, _ = self.locate(name)
+		pkg.export(name, outdir, decompress)
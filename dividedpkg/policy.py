@@ -0,0 +1,120 @@
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+# LZ4F levels: 3 to 12 use the HC compressor, 0 to 2 the fast one, and
+# negative levels the fast one with that much acceleration
+MAX_LEVEL = 12
+FAST_LEVEL = 1
+# Fastest possible, only worth it when LZ4F will store the blocks as they are
+STORE_LEVEL = -65537
+
+# Sampling: how many pieces of what size are tried, and below what size the
+# whole thing is just compressed instead
+SAMPLES = 4
+SAMPLE_SIZE = 16 * 1024
+SAMPLE_MIN = 256 * 1024
+
+
+@dataclass
+class CompressionPolicy:
+	"""
+	How entries are compressed. Levels are as LZ4F takes them, see
+	MAX_LEVEL and FAST_LEVEL. Overrides are (glob, level) pairs matched in
+	order against an entry's name without .lz4, and can use STORE_LEVEL.
+
+	With sample on, data that the fast compressor can't shrink by
+	sample_gain in a few pieces of it is stored instead of compressed.
+	Anything that ends up saving less than min_gain of its size is stored
+	too (when streaming, only the samples are checked against it). Stored
+	entries are still LZ4 frames, just of uncompressed blocks.
+	"""
+	level: int = MAX_LEVEL
+	min_gain: float = 0.0
+	sample: bool = True
+	sample_gain: float = 0.02
+	overrides: list[tuple[str, int]] = field(default_factory=list)
+
+	def __post_init__(self):
+		from .filters import Globs
+		self._overrides = Globs(x for x, _ in self.overrides)
+
+	@classmethod
+	def fast(cls, **kwargs):
+		return cls(level=FAST_LEVEL, **kwargs)
+
+	def level_for(self, name: str):
+		if self._overrides.patterns != [x for x, _ in self.overrides]:
+			# Changed since, compile them again
+			self.__post_init__()
+		i = self._overrides.first(name.removesuffix(".lz4"))
+		return self.overrides[i][1] if i >= 0 else self.level
+
+	def _pays_off(self, samples: list[bytes]):
+		from lz4fwrapper import compress_frame
+		size = sum(map(len, samples))
+		out = sum(len(compress_frame(x, 0)) for x in samples)
+		return out <= size * (1 - max(self.sample_gain, self.min_gain))
+
+	def choose(self, data: bytes|bytearray|memoryview, name: str = ""):
+		"""
+		Level to compress data with, sampling it if enabled.
+		"""
+		level = self.level_for(name)
+		if level == STORE_LEVEL or not self.sample or len(data) < SAMPLE_MIN:
+			return level
+		step = len(data) // SAMPLES
+		samples = [bytes(data[i * step:i * step + SAMPLE_SIZE]) for i in range(SAMPLES)]
+		return level if self._pays_off(samples) else STORE_LEVEL
+
+	def choose_file(self, f: BinaryIO, size: int, name: str = ""):
+		"""
+		Same as choose for data that'll be streamed from f, which is left
+		where it was.
+		"""
+		level = self.level_for(name)
+		if level == STORE_LEVEL or not self.sample or size < SAMPLE_MIN:
+			return level
+		pos = f.tell()
+		step = size // SAMPLES
+		samples = list[bytes]()
+		for i in range(SAMPLES):
+			f.seek(pos + i * step)
+			samples.append(f.read(SAMPLE_SIZE))
+		f.seek(pos)
+		return level if self._pays_off(samples) else STORE_LEVEL
+
+	def compress(self, data: bytes|bytearray|memoryview, name: str = "", cache=None):
+		"""
+		Compress data into a frame following the policy, through a
+		CompressionCache if given.
+		"""
+		from lz4fwrapper import compress_frame
+		def frame(level: int):
+			return cache.compress(data, level) if cache else compress_frame(data, level)
+		level = self.choose(data, name)
+		out = frame(level)
+		if self.min_gain and level != STORE_LEVEL and len(out) > len(data) * (1 - self.min_gain):
+			out = frame(STORE_LEVEL)
+		return out
+
+
+def parse_level(text: str):
+	"""
+	A level given on the command line, a number or "store".
+	"""
+	if text == "store":
+		return STORE_LEVEL
+	try:
+		return int(text)
+	except ValueError:
+		raise ValueError(f"not a level: {text!r}") from None
+
+
+def parse_override(text: str):
+	"""
+	A GLOB=LEVEL override given on the command line, split on the last =.
+	"""
+	glob, sep, level = text.rpartition("=")
+	if not sep or not glob:
+		raise ValueError(f"expected GLOB=LEVEL: {text!r}")
+	return glob, parse_level(level)
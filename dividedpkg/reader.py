@@ -0,0 +1,188 @@
+import io
+from bisect import bisect_right
+
+from . import stats, xor_buffer
+
+FRAME_MAGIC = 0x184D2204
+# Block maximum sizes by the frame's block size ID
+BLOCK_SIZES = {4: 64 << 10, 5: 256 << 10, 6: 1 << 20, 7: 4 << 20}
+
+
+class EntryReader(io.RawIOBase):
+	"""
+	Seekable, read-only file over an entry's stored bytes, decrypted as
+	they're read. With decompress, .lz4 entries read as their contents,
+	and frames of independent blocks only decode the blocks a read covers,
+	found through an index of block positions built on first use. Other
+	frames are decompressed whole the first time they're read.
+	"""
+	def __init__(self, src: memoryview, key: bytes|None, key_offset: int, name: str,
+		decompress=True,
+	):
+		super().__init__()
+		self._src = src
+		self._key = key
+		self._key_offset = key_offset
+		self.name = name
+		self.pos = 0
+		self.decompress = decompress and name.endswith(".lz4") and len(src) > 0
+		# Block index: compressed position and size, stored uncompressed, and
+		# where each block starts once decompressed
+		self._blocks = list[tuple[int, int, bool]]()
+		self._starts = list[int]()
+		self._block_size = 0
+		self._size: int|None = None if self.decompress else len(src)
+		# Only set if the frame can't be read a block at a time
+		self._whole: bytes|None = None
+		# Last block decoded, most reads are near the one before
+		self._cached = (-1, b"")
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def close(self):
+		if not self.closed:
+			self._src.release()
+			self._cached = (-1, b"")
+			self._whole = None
+		super().close()
+
+	def _raw(self, start: int, end: int):
+		"""
+		Stored bytes between start and end, decrypted.
+		"""
+		t = stats.clock()
+		data = bytearray(self._src[start:end])
+		stats.emit("read", self.name, t, len(data))
+		if self._key:
+			t = stats.clock()
+			xor_buffer(data, self._key, self._key_offset + start)
+			stats.emit("xor", self.name, t, len(data))
+		return data
+
+	def _index(self):
+		if self._starts or self._whole is not None:
+			return
+		header = self._raw(0, 19)
+		flags = header[4]
+		if int.from_bytes(header[:4], "little") != FRAME_MAGIC or flags >> 6 != 1:
+			raise RuntimeError(f"{self.name} is not an LZ4 frame")
+		if not flags & 0x20:
+			# Blocks depend on the ones before, no skipping ahead
+			from lz4fwrapper import decompress_frame
+			self._whole = decompress_frame(self._raw(0, len(self._src)))
+			self._size = len(self._whole)
+			return
+		self._block_size = BLOCK_SIZES[header[5] >> 4 & 7]
+		pos = 7
+		if flags & 0x08:
+			self._size = int.from_bytes(header[6:14], "little")
+			pos += 8
+		if flags & 0x01:
+			pos += 4
+		checksum = 4 if flags & 0x10 else 0
+
+		start = 0
+		while True:
+			word = int.from_bytes(self._raw(pos, pos + 4), "little")
+			pos += 4
+			if word == 0:
+				break
+			size = word & 0x7FFFFFFF
+			self._blocks.append((pos, size, bool(word & 0x80000000)))
+			self._starts.append(start)
+			start += self._block_size
+			pos += size + checksum
+		self._starts.append(start)
+		full = len(self._blocks) * self._block_size
+		# A block flushed early can be short anywhere, so the content size
+		# only pins the layout down when all blocks are full or there's one
+		if self._size is not None and (
+			self._size == full or len(self._blocks) == 1 and self._size <= full
+		):
+			self._starts[-1] = self._size
+		else:
+			self._reindex()
+
+	def _block(self, i: int):
+		if self._cached[0] == i:
+			return self._cached[1]
+		pos, size, stored = self._blocks[i]
+		data = self._raw(pos, pos + size)
+		if not stored:
+			from lz4fwrapper import decompress_block
+			t = stats.clock()
+			data = decompress_block(data, self._block_size)
+			stats.emit("decompress", self.name, t, len(data))
+		if len(data) != self._starts[i + 1] - self._starts[i]:
+			raise RuntimeError(f"{self.name} has a block of the wrong size")
+		self._cached = (i, data)
+		return data
+
+	def _reindex(self):
+		"""
+		Find where each block starts from the sizes they decompress to,
+		which for compressed ones means walking them but not decoding.
+		"""
+		from lz4fwrapper import block_content_size
+		start = 0
+		self._starts.clear()
+		for pos, size, stored in self._blocks:
+			self._starts.append(start)
+			start += size if stored else block_content_size(self._raw(pos, pos + size))
+		self._starts.append(start)
+		self._size = start
+
+	@property
+	def size(self):
+		if self._size is None:
+			self._index()
+		return self._size
+
+	def seek(self, offset: int, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			pos = offset
+		elif whence == io.SEEK_CUR:
+			pos = self.pos + offset
+		elif whence == io.SEEK_END:
+			pos = self.size + offset
+		else:
+			raise ValueError(f"invalid whence ({whence})")
+		if pos < 0:
+			raise ValueError(f"negative seek position {pos}")
+		self.pos = pos
+		return pos
+
+	def tell(self):
+		return self.pos
+
+	def readall(self):
+		out = bytearray(max(self.size - self.pos, 0))
+		del out[self.readinto(out):]
+		return bytes(out)
+
+	def readinto(self, buffer):
+		out = memoryview(buffer).cast("B")
+		end = min(self.pos + len(out), self.size)
+		if end <= self.pos:
+			return 0
+		if not self.decompress:
+			out[:end - self.pos] = self._raw(self.pos, end)
+		elif self._whole is not None:
+			out[:end - self.pos] = self._whole[self.pos:end]
+		else:
+			done = 0
+			while self.pos + done < end:
+				at = self.pos + done
+				i = bisect_right(self._starts, at) - 1
+				data = self._block(i)
+				n = min(end - at, self._starts[i + 1] - at)
+				skip = at - self._starts[i]
+				out[done:done + n] = data[skip:skip + n]
+				done += n
+		n = end - self.pos
+		self.pos = end
+		return n
@@ -0,0 +1,281 @@
+"""
+Local server keeping pkgs loaded between commands: file tables stay parsed,
+the key stays read and recently read entries stay in memory. It listens on
+localhost over HTTP and only answers requests carrying the token it writes
+to its state file next to the other caches, which is also how the CLI
+finds it and forwards list and unpack commands to it.
+"""
+import http.client
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from secrets import token_hex
+from threading import Lock
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from . import PKG, READ_CACHE_SIZE, get_key
+from .cache import EntryCache, default_cache_dir
+from .filters import Filter
+from .index import IndexCache
+
+TOKEN_HEADER = "X-DividedPKG-Token"
+# Where the state file goes instead, to run a server of its own (for tests)
+STATE_ENV = "DIVIDEDPKG_SERVER_STATE"
+
+
+def state_path():
+	return Path(os.environ.get(STATE_ENV) or default_cache_dir() / "server.json")
+
+
+def _flag(value: str):
+	return value not in ("", "0", "false", "no")
+
+
+def filter_params(filter: Filter):
+	"""
+	A Filter as query parameters, see filter_from_params.
+	"""
+	params = list[tuple[str, str]]()
+	params += [("include", x) for x in filter.include]
+	params += [("exclude", x) for x in filter.exclude]
+	params += [("ext", x) for x in filter.extensions]
+	if filter.min_size is not None:
+		params.append(("min_size", str(filter.min_size)))
+	if filter.max_size is not None:
+		params.append(("max_size", str(filter.max_size)))
+	if filter.compressed is not None:
+		params.append(("compressed", str(int(filter.compressed))))
+	if filter.substring:
+		params.append(("substring", "1"))
+	return params
+
+
+def filter_from_params(query: dict[str, list[str]]):
+	def size(key: str):
+		return int(query[key][0]) if key in query else None
+	return Filter(query.get("include", []), query.get("exclude", []),
+		min_size=size("min_size"), max_size=size("max_size"),
+		extensions=query.get("ext", []),
+		compressed=_flag(query["compressed"][0]) if "compressed" in query else None,
+		substring=_flag(query.get("substring", [""])[0]))
+
+
+class PKGServer(ThreadingHTTPServer):
+	"""
+	Serves /list, /read and /export for pkgs given by path, loading each
+	one once and again only when its file changes. All of them share one
+	read cache. Maps are dropped whenever no request is running, so the
+	files can still be replaced (on Windows a mapped file can't be renamed).
+	"""
+	daemon_threads = True
+
+	def __init__(self, port=0, cache_size=READ_CACHE_SIZE, index: IndexCache|None = None):
+		super().__init__(("127.0.0.1", port), _Handler)
+		self.token = token_hex(16)
+		self.cache = EntryCache(cache_size)
+		self.index = index
+		# Resolved path and encryption to the pkg and the file's size and mtime
+		self.pkgs = dict[tuple[str, bool|None], tuple[PKG, int, int]]()
+		self.active = 0
+		self._lock = Lock()
+		get_key()
+
+	def pkg(self, fn: str, encrypted: bool|None = None):
+		path = str(Path(fn).resolve())
+		st = os.stat(path)
+		with self._lock:
+			held = self.pkgs.get((path, encrypted))
+			if held and held[1:] == (st.st_size, st.st_mtime_ns):
+				return held[0]
+			if held:
+				held[0]._forget()
+				held[0].close()
+			pkg = PKG.load(path, encrypted=encrypted, index=self.index)
+			pkg.cache = self.cache
+			self.pkgs[(path, encrypted)] = (pkg, st.st_size, st.st_mtime_ns)
+			return pkg
+
+	def begin(self):
+		with self._lock:
+			self.active += 1
+
+	def end(self):
+		with self._lock:
+			self.active -= 1
+			if not self.active:
+				for pkg, _, _ in self.pkgs.values():
+					pkg.close()
+
+	def serve(self):
+		"""
+		Run until shut down, advertising the server in the state file.
+		"""
+		fp = state_path()
+		fp.parent.mkdir(parents=True, exist_ok=True)
+		tmp = fp.with_name(f"{fp.name}.{os.getpid()}.tmp")
+		# Only readable by this user where that's up to the mode
+		tmp.touch(0o600)
+		tmp.write_text(json.dumps({"port": self.server_address[1], "pid": os.getpid(),
+			"token": self.token}))
+		os.replace(tmp, fp)
+		try:
+			self.serve_forever()
+		finally:
+			self.server_close()
+			try:
+				if json.loads(fp.read_text()).get("token") == self.token:
+					fp.unlink()
+			except (OSError, ValueError):
+				pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+	server: PKGServer
+	# Keep-alive, so a client reuses its connection
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *_):
+		pass
+
+	def _reply(self, status: int, body: bytes, content_type="text/plain; charset=utf-8"):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		self._handle()
+
+	def do_POST(self):
+		self._handle()
+
+	def _handle(self):
+		if self.headers.get(TOKEN_HEADER) != self.server.token:
+			return self._reply(403, b"bad token")
+		url = urlsplit(self.path)
+		query = parse_qs(url.query)
+		route = {
+			"/ping": self._ping,
+			"/list": self._list,
+			"/read": self._read,
+			"/export": self._export,
+			"/shutdown": self._shutdown,
+		}.get(url.path)
+		if not route:
+			return self._reply(404, f"no such request: {url.path}".encode())
+		self.server.begin()
+		try:
+			status, body, content_type = 200, *route(query)
+		except (FileNotFoundError, KeyError) as err:
+			status, body, content_type = 404, str(err).encode(), "text/plain; charset=utf-8"
+		except (ValueError, RuntimeError) as err:
+			status, body, content_type = 400, str(err).encode(), "text/plain; charset=utf-8"
+		finally:
+			self.server.end()
+		self._reply(status, body, content_type)
+
+	def _pkg(self, query: dict[str, list[str]]):
+		encrypted = _flag(query["encrypted"][0]) if "encrypted" in query else None
+		return self.server.pkg(query["pkg"][0], encrypted)
+
+	def _ping(self, query: dict[str, list[str]]):
+		cache = self.server.cache
+		state = {"pid": os.getpid(), "pkgs": len(self.server.pkgs),
+			"cached": cache.size, "hits": cache.hits, "misses": cache.misses}
+		return json.dumps(state).encode(), "application/json"
+
+	def _list(self, query: dict[str, list[str]]):
+		from .pipeline import listing
+		lines = listing(self._pkg(query), filter_from_params(query))
+		return "\n".join(lines).encode(), "text/plain; charset=utf-8"
+
+	def _read(self, query: dict[str, list[str]]):
+		data = self._pkg(query).read(query["name"][0],
+			decompress=_flag(query.get("decompress", ["1"])[0]))
+		return bytes(data), "application/octet-stream"
+
+	def _export(self, query: dict[str, list[str]]):
+		count = self._pkg(query).export_all(query["out"][0],
+			decompress=_flag(query.get("decompress", ["1"])[0]),
+			jobs=int(query.get("jobs", ["1"])[0]), filter=filter_from_params(query))
+		return str(count).encode(), "text/plain; charset=utf-8"
+
+	def _shutdown(self, query: dict[str, list[str]]):
+		# Can't wait for serve_forever to stop from inside a request
+		from threading import Thread
+		Thread(target=self.server.shutdown, daemon=True).start()
+		return b"bye", "text/plain; charset=utf-8"
+
+
+class Client:
+	"""
+	Connection to a running PKGServer. Paths are sent resolved since the
+	server has its own working directory.
+	"""
+	def __init__(self, port: int, token: str, timeout: float|None = None):
+		self.token = token
+		self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+
+	@classmethod
+	def connect(cls, timeout=0.5):
+		"""
+		The server from the state file, or None if there isn't one running.
+		"""
+		try:
+			state = json.loads(state_path().read_text())
+			client = cls(state["port"], state["token"], timeout)
+			client.request("/ping")
+		except (OSError, ValueError, KeyError):
+			return None
+		# Long exports shouldn't time out
+		client.conn.timeout = None
+		if client.conn.sock:
+			client.conn.sock.settimeout(None)
+		return client
+
+	def close(self):
+		self.conn.close()
+
+	def request(self, path: str, params: list[tuple[str, str]] = [], method="GET"):
+		self.conn.request(method, f"{path}?{urlencode(params)}", headers={TOKEN_HEADER: self.token})
+		response = self.conn.getresponse()
+		body = response.read()
+		if response.status == 404:
+			raise FileNotFoundError(body.decode())
+		if response.status != 200:
+			raise RuntimeError(body.decode())
+		return body
+
+	@staticmethod
+	def _pkg(pkg: str|Path, encrypted: bool|None):
+		params = [("pkg", str(Path(pkg).resolve()))]
+		if encrypted is not None:
+			params.append(("encrypted", str(int(encrypted))))
+		return params
+
+	def list(self, pkg: str|Path, filter: Filter = Filter(), encrypted: bool|None = None):
+		"""
+		Lines of the -l listing.
+		"""
+		body = self.request("/list", self._pkg(pkg, encrypted) + filter_params(filter))
+		return body.decode().split("\n")
+
+	def read(self, pkg: str|Path, name: str, decompress=True, encrypted: bool|None = None):
+		return self.request("/read", self._pkg(pkg, encrypted)
+			+ [("name", name), ("decompress", str(int(decompress)))])
+
+	def export(self, pkg: str|Path, outdir: str|Path, filter: Filter = Filter(),
+		decompress=True, jobs=1, encrypted: bool|None = None,
+	):
+		"""
+		Same as PKG.export_all, returns how many files were written.
+		"""
+		params = self._pkg(pkg, encrypted) + filter_params(filter) + [
+			("out", str(Path(outdir).resolve())), ("decompress", str(int(decompress))),
+			("jobs", str(jobs))]
+		return int(self.request("/export", params, "POST"))
+
+	def shutdown(self):
+		self.request("/shutdown", method="POST")
@@ -0,0 +1,123 @@
+"""
+Timings of loading file tables (load, with the table's size in the pkg, or
+0 from the index) and of the stages entries go through (read, xor,
+compress, decompress, write, and copy for data the OS moves between files
+without reading it).
+Operations report to every callable in hooks as
+hook(stage, name, seconds, nbytes), with nbytes being the uncompressed size
+for compress and decompress. While hooks is empty nothing is timed.
+"""
+from collections.abc import Callable
+from threading import Lock
+from time import perf_counter
+from typing import BinaryIO
+
+Hook = Callable[[str, str, float, int], None]
+hooks = list[Hook]()
+
+
+def clock():
+	"""
+	Start time for emit, or 0 if nobody's listening.
+	"""
+	return perf_counter() if hooks else 0.0
+
+
+def emit(stage: str, name: str, start: float, nbytes: int):
+	"""
+	Report a stage that began at start (from clock) and returns how long it
+	took, or 0 if timing is off.
+	"""
+	if not start:
+		return 0.0
+	seconds = perf_counter() - start
+	for hook in hooks:
+		hook(stage, name, seconds, nbytes)
+	return seconds
+
+
+class TimedFile:
+	"""
+	File wrapper that reports its reads or writes as stage, and keeps the
+	total time spent in them in busy.
+	"""
+	def __init__(self, f: BinaryIO, stage: str, name: str):
+		self.f = f
+		self.stage = stage
+		self.name = name
+		self.busy = 0.0
+
+	def read(self, size=-1):
+		t = clock()
+		data = self.f.read(size)
+		self.busy += emit(self.stage, self.name, t, len(data))
+		return data
+
+	def write(self, data):
+		t = clock()
+		ret = self.f.write(data)
+		self.busy += emit(self.stage, self.name, t, len(data))
+		return ret
+
+
+class Stats:
+	"""
+	Hook adding up the time, bytes and number of events of each stage.
+	Use as a context manager to collect stats for a block.
+	Stage times from worker threads are summed, so with several jobs a
+	stage can add up to more than the wall time.
+	"""
+	ORDER = ("load", "read", "xor", "decompress", "compress", "write", "copy")
+
+	def __init__(self):
+		self.stages = dict[str, list]()
+		self.started = 0.0
+		self.wall = 0.0
+		self._lock = Lock()
+
+	def __call__(self, stage: str, name: str, seconds: float, nbytes: int):
+		with self._lock:
+			totals = self.stages.setdefault(stage, [0, 0.0, 0])
+			totals[0] += 1
+			totals[1] += seconds
+			totals[2] += nbytes
+
+	def merge(self, stages: dict[str, list]):
+		"""
+		Add totals collected elsewhere, like another process.
+		"""
+		for stage, (count, seconds, nbytes) in stages.items():
+			with self._lock:
+				totals = self.stages.setdefault(stage, [0, 0.0, 0])
+				totals[0] += count
+				totals[1] += seconds
+				totals[2] += nbytes
+
+	def start(self):
+		self.started = perf_counter()
+		hooks.append(self)
+		return self
+
+	def stop(self):
+		if self in hooks:
+			hooks.remove(self)
+			self.wall = perf_counter() - self.started
+		return self
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *_):
+		self.stop()
+
+	def summary(self):
+		order = [x for x in self.ORDER if x in self.stages]
+		order += sorted(x for x in self.stages if x not in self.ORDER)
+		lines = [f"{'stage':10s}  {'count':>8s}  {'MB':>10s}  {'seconds':>9s}  {'MB/s':>9s}"]
+		for stage in order:
+			count, seconds, nbytes = self.stages[stage]
+			rate = f"{nbytes / seconds / 1e6:9.1f}" if seconds else f"{'-':>9s}"
+			lines.append(f"{stage:10s}  {count:8d}  {nbytes / 1e6:10.2f}  {seconds:9.3f}  {rate}")
+		if self.wall:
+			lines.append(f"{'total':10s}  {'':8s}  {'':10s}  {self.wall:9.3f}")
+		return "\n".join(lines)
@@ -0,0 +1,261 @@
+import re
+import sys
+from array import array
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator, MutableMapping
+from itertools import accumulate
+
+from .policy import CompressionPolicy
+
+
+def little_endian(arr: array):
+	"""
+	arr with its items little endian, as files store them regardless of
+	platform. Swapped in place.
+	"""
+	if sys.byteorder == "big":
+		arr.byteswap()
+	return arr
+
+
+class FileTable(MutableMapping[str, "FileEntry"]):
+	"""
+	A pkg's file table stored in columns: sizes, offsets and dummy fields in
+	arrays, and every name in one blob, each followed by a newline. Acts as
+	a dict of name to FileEntry, where entries are views of a row.
+
+	Rows keep their position unless something is deleted, which renumbers
+	everything after it and so invalidates existing views.
+	"""
+	def __init__(self):
+		self.sizes = array("Q")
+		self.offsets = array("Q")
+		self.dummies = array("I")
+		self.name_starts = array("Q")
+		self.names_blob = bytearray()
+		# Pending data by row, most rows have none
+		self.data = dict[int, bytes]()
+		self._rows: dict[str, int]|None = None
+
+	@classmethod
+	def from_columns(cls, names: Iterable[str], sizes: Iterable[int],
+		dummies: Iterable[int], offsets: Iterable[int],
+	):
+		encoded = [x.encode("ascii") for x in names]
+		return cls.from_blob(bytearray(b"".join(x + b"\n" for x in encoded)),
+			array("Q", accumulate((len(x) + 1 for x in encoded[:-1]), initial=0) if encoded else ()),
+			array("Q", sizes), array("I", dummies), array("Q", offsets))
+
+	@classmethod
+	def from_blob(cls, names_blob: bytearray, name_starts: array,
+		sizes: array, dummies: array, offsets: array,
+	):
+		"""
+		A table from names already laid out as names_blob and name_starts,
+		and columns with the typecodes it uses. All are taken without copying.
+		"""
+		ret = cls()
+		ret.names_blob = names_blob
+		ret.name_starts = name_starts
+		ret.sizes = sizes
+		ret.dummies = dummies
+		ret.offsets = offsets
+		if not len(ret.sizes) == len(ret.dummies) == len(ret.offsets) == len(ret.name_starts):
+			raise ValueError("columns have different lengths")
+		return ret
+
+	def __len__(self):
+		return len(self.sizes)
+
+	def name(self, row: int):
+		start = self.name_starts[row]
+		return self.names_blob[start:self.names_blob.index(b"\n", start)].decode("ascii")
+
+	def names(self):
+		if not self.names_blob:
+			return list[str]()
+		return self.names_blob[:-1].decode("ascii").split("\n")
+
+	def row(self, name: str):
+		if self._rows is None:
+			self._rows = {x: i for i, x in enumerate(self.names())}
+		return self._rows[name]
+
+	def entry(self, row: int):
+		ret = FileEntry.__new__(FileEntry)
+		ret._table = self
+		ret._row = row
+		return ret
+
+	def append(self, name: str, size: int, dummy: int, offset: int, data: bytes = b""):
+		if "\n" in name:
+			raise ValueError("file names can't contain newlines")
+		row = len(self.sizes)
+		self.name_starts.append(len(self.names_blob))
+		self.names_blob += name.encode("ascii") + b"\n"
+		self.sizes.append(size)
+		self.dummies.append(dummy)
+		self.offsets.append(offset)
+		if data:
+			self.data[row] = data
+		if self._rows is not None:
+			self._rows[name] = row
+		return row
+
+	def __getitem__(self, name: str):
+		return self.entry(self.row(name))
+
+	def __contains__(self, name: object):
+		try:
+			self.row(name)  # type: ignore
+		except (KeyError, TypeError):
+			return False
+		return True
+
+	def __setitem__(self, name: str, entry: "FileEntry"):
+		values = (entry.size, entry.dummy, entry.offset, entry.data)
+		if name in self:
+			row = self.row(name)
+			self.sizes[row], self.dummies[row], self.offsets[row], data = values
+			self.data.pop(row, None)
+			if data:
+				self.data[row] = data
+		else:
+			row = self.append(name, *values)
+		# The entry is a view of this table from now on
+		entry._table = self
+		entry._row = row
+
+	def __delitem__(self, name: str):
+		row = self.row(name)
+		keep = [i for i in range(len(self)) if i != row]
+		names = self.names()
+		rebuilt = FileTable.from_columns(
+			(names[i] for i in keep),
+			(self.sizes[i] for i in keep),
+			(self.dummies[i] for i in keep),
+			(self.offsets[i] for i in keep),
+		)
+		rebuilt.data = {i - (i > row): v for i, v in self.data.items() if i != row}
+		self.__dict__.update(rebuilt.__dict__)
+
+	def clear(self):
+		self.__init__()
+
+	def __iter__(self) -> Iterator[str]:
+		return iter(self.names())
+
+	def keys(self):  # type: ignore[override]
+		return self.names()
+
+	def values(self):  # type: ignore[override]
+		return [self.entry(i) for i in range(len(self))]
+
+	def items(self):  # type: ignore[override]
+		return [(name, self.entry(i)) for i, name in enumerate(self.names())]
+
+	def by_offset(self):
+		"""
+		Rows in the order their data is laid out.
+		"""
+		rows = range(len(self))
+		offsets = self.offsets
+		if all(offsets[i] <= offsets[i + 1] for i in rows[:-1]):
+			return list(rows)
+		return sorted(rows, key=offsets.__getitem__)
+
+	def sorted_by_offset(self):
+		return [self.entry(i) for i in self.by_offset()]
+
+	def match(self, pattern: re.Pattern[bytes]):
+		"""
+		Rows whose name pattern matches, found in one pass over the names.
+		The pattern is searched with re.MULTILINE semantics against the blob,
+		so it should be anchored with ^ and $ and must not cross newlines.
+		"""
+		rows = list[int]()
+		last = -1
+		for m in pattern.finditer(self.names_blob):
+			row = bisect_right(self.name_starts, m.start()) - 1
+			if row != last:
+				rows.append(row)
+				last = row
+		return rows
+
+	def name_lengths(self):
+		"""
+		Length of each name, from the gaps between name starts.
+		"""
+		ends = list(self.name_starts[1:]) + [len(self.names_blob)]
+		return [end - start - 1 for start, end in zip(self.name_starts, ends)]
+
+
+class FileEntry:
+	"""
+	One row of a FileTable. Creating one directly makes a detached entry
+	backed by a table of its own until it's put into a pkg's table.
+	"""
+	__slots__ = ("_table", "_row")
+	_table: FileTable
+	_row: int
+
+	def __init__(self, name: str, size: int, dummy: int, offset: int, data: bytes = b""):
+		self._table = FileTable()
+		self._row = self._table.append(name, size, dummy, offset, data)
+
+	# Part of the table
+	@property
+	def name(self):
+		return self._table.name(self._row)
+
+	@property
+	def size(self):
+		return self._table.sizes[self._row]
+
+	@size.setter
+	def size(self, value: int):
+		self._table.sizes[self._row] = value
+
+	@property
+	def dummy(self):  # version? count? always(?) 1
+		return self._table.dummies[self._row]
+
+	@dummy.setter
+	def dummy(self, value: int):
+		self._table.dummies[self._row] = value
+
+	# Extra info
+	@property
+	def offset(self):
+		return self._table.offsets[self._row]
+
+	@offset.setter
+	def offset(self, value: int):
+		self._table.offsets[self._row] = value
+
+	@property
+	def data(self):
+		return self._table.data.get(self._row, b"")
+
+	@data.setter
+	def data(self, value: bytes):
+		if value:
+			self._table.data[self._row] = value
+		else:
+			self._table.data.pop(self._row, None)
+
+	def _fields(self):
+		return (self.name, self.size, self.dummy, self.offset, self.data)
+
+	def __eq__(self, other: object):
+		if not isinstance(other, FileEntry):
+			return NotImplemented
+		return self._fields() == other._fields()
+
+	def __repr__(self):
+		return ("FileEntry(name={!r}, size={!r}, dummy={!r}, offset={!r}, data={!r})"
+			.format(*self._fields()))
+
+	def compress(self, data: bytes, policy: CompressionPolicy|None = None):
+		from . import COMPRESSION
+		self.data = bytearray((policy or COMPRESSION).compress(data, self.name))
@@ -0,0 +1,186 @@
+import os
+import shutil
+from array import array
+from collections.abc import Iterable
+from pathlib import Path
+from typing import BinaryIO
+
+from . import (CHUNK_SIZE, COMPRESSION, HEADER_SIZE, PKG, CryptWriter, ScratchBuffer,
+	check_backup, copy_data, get_backup_name, get_key, stats, xor_buffer)
+from .policy import CompressionPolicy
+
+Source = bytes|bytearray|memoryview|BinaryIO
+
+
+def table_size(names: Iterable[str]):
+	"""
+	Size of the header and file table for entries with these names.
+	"""
+	# Length and filename, size, dummy
+	return HEADER_SIZE + sum(8 + len(x) + 8 + 4 for x in names)
+
+
+class PKGWriter:
+	"""
+	Builds a pkg by writing entries one after another as they're added,
+	encrypted on the way, without them having to be in a folder first.
+	Entries are laid out in the order they're added.
+
+	The file table goes before the data and its size depends on the names,
+	so give names up front to have its space reserved; otherwise (or if
+	other names are added) the data is moved into place once at the end.
+	"""
+	def __init__(self, fn: str|Path, *, encrypt=True, names: Iterable[str]|None = None,
+		policy: CompressionPolicy|None = None,
+	):
+		self.pkg = PKG()
+		self.pkg.encrypted = encrypt
+		self.pkg.format = "Reverge Package File"
+		self.pkg.version = "1.1"
+		self.pkg.filename = Path(fn)
+		self.policy = policy or COMPRESSION
+		self.key = get_key() if encrypt else None
+		self.start = table_size(names or ())
+		self.offset = self.start
+		self.buffer = ScratchBuffer()
+		# Pkgs copied from by copy, by path
+		self._sources = dict[Path, BinaryIO]()
+
+		if self.pkg.filename.exists():
+			self.pkg.filename.rename(check_backup(self.pkg.filename))
+			self.pkg.backed_up = True
+		self._f = self.pkg.filename.open("wb", buffering=CHUNK_SIZE)
+		self._f.seek(self.start)
+
+	def add(self, name: str, src: Source, compress=False, size: int|None = None):
+		"""
+		Write an entry from bytes or a file-like object. With compress, it's
+		stored as an LZ4 frame following the policy, and .lz4 is added to the
+		name if it's missing. Without, .lz4 entries must already be frames.
+		size is how much a stream holds, if known. Returns the stored name.
+		"""
+		if compress and not name.endswith(".lz4"):
+			name += ".lz4"
+		if name in self.pkg.files:
+			raise ValueError(f"{name} added twice")
+		out = CryptWriter(self._f, self.offset, self.key, name, self.buffer)
+		if isinstance(src, (bytes, bytearray, memoryview)):
+			if compress:
+				t = stats.clock()
+				frame = self.policy.compress(src, name)
+				stats.emit("compress", name, t, len(src))
+				src = frame
+			out.write(src)
+		elif compress:
+			from lz4fwrapper import compress_stream
+			if size is not None and src.seekable():
+				level = self.policy.choose_file(src, size, name)
+			else:
+				level = self.policy.level_for(name)
+			t = stats.clock()
+			compress_stream(src, out, level, size or 0)
+			if t:
+				stats.emit("compress", name, t + out.busy, size or 0)
+		else:
+			shutil.copyfileobj(src, out, CHUNK_SIZE)
+		self.pkg.files.append(name, out.written, 1, self.offset)
+		self.offset += out.written
+		return name
+
+	def copy(self, pkg: PKG, name: str, new_name: str|None = None):
+		"""
+		Add an entry as it's stored in another pkg, under new_name if given.
+		Nothing is decompressed, and encrypted data is only re-keyed for
+		where it lands.
+		"""
+		new_name = new_name or name
+		if new_name in self.pkg.files:
+			raise ValueError(f"{new_name} added twice")
+		entry = pkg.files[name]
+		if entry.data:
+			size = CryptWriter(self._f, self.offset, self.key, new_name, self.buffer).write(entry.data)
+		elif bool(pkg.encrypted) == bool(self.key):
+			if pkg.filename not in self._sources:
+				self._sources[pkg.filename] = pkg.filename.open("rb")
+			copy_data(self._sources[pkg.filename], self._f, entry.offset, self.offset, entry.size,
+				self.key, self.key, new_name, self.buffer)
+			size = entry.size
+		else:
+			out = CryptWriter(self._f, self.offset, self.key, new_name, self.buffer)
+			with pkg.open(name, decompress=False) as src:
+				shutil.copyfileobj(src, out, CHUNK_SIZE)
+			size = out.written
+		self.pkg.files.append(new_name, size, entry.dummy, self.offset)
+		self.offset += size
+		return new_name
+
+	def add_all(self, items: Iterable[tuple[str, Source, bool]]):
+		for name, src, compress in items:
+			self.add(name, src, compress)
+
+	def close(self):
+		"""
+		Write the file table and return the finished pkg.
+		"""
+		if self._f.closed:
+			return self.pkg
+		self._close_sources()
+		self.pkg.count = len(self.pkg.files)
+		header = self.pkg._table_bytes({})
+		if self.key:
+			xor_buffer(header, self.key, 0)
+		if len(header) == self.start:
+			self._f.seek(0)
+			self._f.write(header)
+			self._f.close()
+			return self.pkg
+
+		# Table didn't fit, move the data after it
+		self._f.close()
+		moved = self.pkg.filename.with_name(self.pkg.filename.name + ".tmp")
+		with self.pkg.filename.open("rb") as fin, moved.open("wb") as fout:
+			fout.write(header)
+			copy_data(fin, fout, self.start, len(header), self.offset - self.start,
+				self.key, self.key, buffer=self.buffer)
+		os.replace(moved, self.pkg.filename)
+		shift = len(header) - self.start
+		self.pkg.files.offsets = array("Q", (x + shift for x in self.pkg.files.offsets))
+		self.start = len(header)
+		return self.pkg
+
+	def abort(self):
+		"""
+		Stop and delete what was written so far, putting back the pkg it
+		replaced if there was one.
+		"""
+		self._close_sources()
+		if not self._f.closed:
+			self._f.close()
+		if self.pkg.backed_up:
+			os.replace(get_backup_name(self.pkg.filename), self.pkg.filename)
+			self.pkg.backed_up = False
+		else:
+			self.pkg.filename.unlink(missing_ok=True)
+
+	def _close_sources(self):
+		for f in self._sources.values():
+			f.close()
+		self._sources.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *_):
+		if exc_type:
+			self.abort()
+		else:
+			self.close()
+
+	@classmethod
+	def build(cls, fn: str|Path, items: Iterable[tuple[str, Source, bool]], **kwargs):
+		"""
+		Write a pkg from (name, bytes or stream, compress) items in one go.
+		"""
+		with cls(fn, **kwargs) as writer:
+			writer.add_all(items)
+		return writer.pkg
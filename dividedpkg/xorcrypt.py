@@ -1,23 +1,148 @@
 import cython
 from cython.parallel import prange # type: ignore
+from cython.cimports.libc.string import memcpy # type: ignore
+
+# Buffers smaller than this aren't worth starting threads for
+PARALLEL_MIN = 1 << 20
+# Amount of data each thread works on at a time
+BLOCK_SIZE = 1 << 18
+
+# The key twice over, so a run of up to len(key) bytes starting anywhere in
+# the key is contiguous and never has to wrap
+_tiled_src: object = None
+_tiled: bytes = b""
+
+
+def tiled_key(key: bytes) -> bytes:
+	global _tiled_src, _tiled
+	if key is not _tiled_src:
+		_tiled = key + key
+		_tiled_src = key
+	return _tiled
+
+
+@cython.cfunc
+@cython.nogil
+@cython.exceptval(check=False)
+def _xor_run(dst: cython.p_uchar, src: cython.p_uchar, n: cython.Py_ssize_t) -> cython.void:
+	i: cython.Py_ssize_t = 0
+	a: cython.ulonglong
+	b: cython.ulonglong
+	# A word at a time, memcpy keeps the loads unaligned-safe and the
+	# compiler turns them into plain moves (or vectorizes the loop)
+	while i + 8 <= n:
+		memcpy(cython.address(a), dst + i, 8)
+		memcpy(cython.address(b), src + i, 8)
+		a ^= b
+		memcpy(dst + i, cython.address(a), 8)
+		i += 8
+	while i < n:
+		dst[i] ^= src[i]
+		i += 1
+
+
+@cython.cfunc
+@cython.nogil
+@cython.exceptval(check=False)
+def _xor2_run(dst: cython.p_uchar, src: cython.p_uchar, src2: cython.p_uchar,
+	n: cython.Py_ssize_t,
+) -> cython.void:
+	i: cython.Py_ssize_t = 0
+	a: cython.ulonglong
+	b: cython.ulonglong
+	c: cython.ulonglong
+	while i + 8 <= n:
+		memcpy(cython.address(a), dst + i, 8)
+		memcpy(cython.address(b), src + i, 8)
+		memcpy(cython.address(c), src2 + i, 8)
+		a ^= b ^ c
+		memcpy(dst + i, cython.address(a), 8)
+		i += 8
+	while i < n:
+		dst[i] ^= src[i] ^ src2[i]
+		i += 1
+
+
+@cython.cfunc
+@cython.nogil
+@cython.exceptval(check=False)
+def _xor_block(data: cython.p_uchar, key: cython.p_uchar, keylen: cython.Py_ssize_t,
+	key_start: cython.Py_ssize_t, key2_start: cython.Py_ssize_t, rekey: cython.bint,
+	pos: cython.Py_ssize_t, n: cython.Py_ssize_t,
+) -> cython.void:
+	run: cython.Py_ssize_t
+	# Every keylen bytes the key comes back around to the same place
+	k: cython.Py_ssize_t = (key_start + pos) % keylen
+	k2: cython.Py_ssize_t = (key2_start + pos) % keylen
+	while n > 0:
+		run = min(n, keylen)
+		if rekey:
+			_xor2_run(data + pos, key + k, key + k2, run)
+		else:
+			_xor_run(data + pos, key + k, run)
+		pos += run
+		n -= run
+
+
+@cython.cfunc
+def _xor(data: cython.uchar[:], key: bytes, key_offset: cython.Py_ssize_t,
+	key2_offset: cython.Py_ssize_t, rekey: cython.bint, threads: cython.bint,
+):
+	n: cython.Py_ssize_t = data.shape[0]
+	keylen: cython.Py_ssize_t = len(key)
+	if n == 0:
+		return
+	if keylen == 0:
+		raise ValueError("empty key")
+
+	tiled: bytes = tiled_key(key)
+	dptr: cython.p_uchar = cython.address(data[0])
+	kptr: cython.p_uchar = cython.cast(cython.p_uchar, cython.cast(cython.p_char, tiled))
+	start: cython.Py_ssize_t = key_offset % keylen
+	start2: cython.Py_ssize_t = key2_offset % keylen
+	block: cython.Py_ssize_t = BLOCK_SIZE
+	blocks: cython.Py_ssize_t = (n + block - 1) // block
+	b: cython.Py_ssize_t
+	if threads and n >= PARALLEL_MIN:
+		for b in prange(blocks, nogil=True, schedule="static"):
+			_xor_block(dptr, kptr, keylen, start, start2, rekey, b * block, min(block, n - b * block))
+	else:
+		with cython.nogil:
+			_xor_block(dptr, kptr, keylen, start, start2, rekey, 0, n)
+
+
+@cython.ccall
+def xor_buffer(data: cython.uchar[:], key: bytes, key_offset: cython.Py_ssize_t):
+	"""
+	XOR data in place with the key starting at key_offset, on this thread.
+	"""
+	_xor(data, key, key_offset, 0, False, False)
+
+
+@cython.ccall
+def xor_parallel(data: cython.uchar[:], key: bytes, key_offset: cython.Py_ssize_t):
+	"""
+	Same as xor_buffer but large buffers are split across threads.
+	"""
+	_xor(data, key, key_offset, 0, False, True)
+
 
-@cython.locals(i="Py_ssize_t", keylen="Py_ssize_t")
 @cython.ccall
-def xor_buffer(data: bytearray, key: bytes, key_offset: cython.Py_ssize_t):
-	dview: cython.uchar[:] = data
-	kview: cython.const_uchar[:] = key
-	keylen = len(key)
-	for i in range(len(data)):
-		dview[i] ^= kview[(i + key_offset) % keylen]
+def rekey_buffer(data: cython.uchar[:], key: bytes, old_offset: cython.Py_ssize_t,
+	new_offset: cython.Py_ssize_t,
+):
+	"""
+	Turn data encrypted for old_offset into data encrypted for new_offset,
+	in one pass, on this thread.
+	"""
+	_xor(data, key, old_offset, new_offset, True, False)
 
 
-@cython.locals(i="Py_ssize_t", n="Py_ssize_t", keylen="Py_ssize_t")
-@cython.boundscheck(False)
 @cython.ccall
-def xor_parallel(data: bytearray, key: bytes, key_offset: cython.Py_ssize_t):
-	dview: cython.uchar[:] = data
-	kview: cython.const_uchar[:] = key
-	n = len(data)
-	keylen = len(key)
-	for i in prange(n, nogil=True, schedule="static"):
-		dview[i] ^= kview[(i + key_offset) % keylen]
+def rekey_parallel(data: cython.uchar[:], key: bytes, old_offset: cython.Py_ssize_t,
+	new_offset: cython.Py_ssize_t,
+):
+	"""
+	Same as rekey_buffer but large buffers are split across threads.
+	"""
+	_xor(data, key, old_offset, new_offset, True, True)
@@ -0,0 +1,44 @@
+"""
+NumPy version of xorcrypt for when the extension isn't built.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=2)
+def tiled_key(key: bytes):
+	# The key twice over, so any run of len(key) bytes is contiguous
+	return np.frombuffer(key + key, dtype=np.uint8)
+
+
+def xor_buffer(data: bytearray|memoryview, key: bytes, key_offset: int):
+	view = np.frombuffer(data, dtype=np.uint8)
+	if not len(view):
+		return
+	tiled = tiled_key(key)
+	keylen = len(key)
+	# Each keylen bytes brings the key back to the same start
+	start = key_offset % keylen
+	for pos in range(0, len(view), keylen):
+		chunk = view[pos:pos + keylen]
+		np.bitwise_xor(chunk, tiled[start:start + len(chunk)], out=chunk)
+
+
+def rekey_buffer(data: bytearray|memoryview, key: bytes, old_offset: int, new_offset: int):
+	view = np.frombuffer(data, dtype=np.uint8)
+	if not len(view):
+		return
+	tiled = tiled_key(key)
+	keylen = len(key)
+	old = old_offset % keylen
+	new = new_offset % keylen
+	for pos in range(0, len(view), keylen):
+		chunk = view[pos:pos + keylen]
+		np.bitwise_xor(chunk, tiled[old:old + len(chunk)], out=chunk)
+		np.bitwise_xor(chunk, tiled[new:new + len(chunk)], out=chunk)
+
+
+# NumPy releases the GIL for large operations already
+xor_parallel = xor_buffer
+rekey_parallel = rekey_buffer
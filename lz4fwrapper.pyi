@@ -1,11 +1,118 @@
-def compress_frame(data: bytes, compressionLevel: int) -> bytes:
-    """
+from typing import BinaryIO, Protocol
+
+CHUNK_SIZE: int
+
+class _Sink(Protocol):
+	def write(self, data: memoryview, /) -> object: ...
+
+SCRATCH_MAX: int
+
+class Context:
+	"""
+	LZ4F compression and decompression state plus a grow-only scratch
+	buffer, kept between calls to save setting them up for every frame.
+	Each thread has its own, see context(). A stream holds its context
+	until it's closed, anything else on that thread meanwhile gets a
+	temporary one.
+	"""
+	def compress(self, src: bytes|bytearray|memoryview, compressionLevel: int) -> bytes: ...
+	def decompress(self, src: bytes|bytearray|memoryview) -> bytes: ...
+	def verify(self, src: bytes|bytearray|memoryview) -> int: ...
+
+def context() -> Context:
+	"""
+	This thread's Context, or a new one if it's being used by a stream.
+	"""
+	...
+
+def compress_frame(data: bytes|bytearray|memoryview, compressionLevel: int) -> bytes:
+	"""
 	LZ4 compress a blob using the frame format.
 	"""
-    ...
+	...
 
-def decompress_frame(src: bytes) -> bytes:
+def decompress_frame(src: bytes|bytearray|memoryview) -> bytes:
 	"""
 	Decompress a LZ4 compressed frame
 	"""
 	...
+
+def verify_frame(src: bytes|bytearray|memoryview) -> int:
+	"""
+	Decode a frame without keeping the output, so its block and content
+	checksums (if it has them) and content size get checked. Returns the
+	decompressed size.
+	"""
+	...
+
+def decompress_block(src: bytes|bytearray|memoryview, maxSize: int) -> bytearray:
+	"""
+	Decompress a single block from inside a frame (without its size or
+	checksum), which must not depend on earlier blocks.
+	"""
+	...
+
+def block_content_size(src: bytes|bytearray|memoryview) -> int:
+	"""
+	Size a single block from inside a frame decompresses to, found by
+	walking its sequences without decoding them.
+	"""
+	...
+
+class FrameCompressor:
+	"""
+	Incrementally compress into an LZ4 frame, in the same format as
+	compress_frame, writing the result to a file-like sink.
+	The sink must be done with each buffer when its write returns.
+	"""
+	sink: _Sink
+	closed: bool
+	bytes_in: int
+	bytes_out: int
+	def __init__(self, sink: _Sink, compressionLevel: int, contentSize: int = 0): ...
+	def __enter__(self) -> FrameCompressor: ...
+	def __exit__(self, *exc) -> None: ...
+	def write(self, data: bytes|bytearray|memoryview) -> int: ...
+	def flush(self) -> None:
+		"""
+		Write out anything LZ4F is holding on to, ending the current block.
+		"""
+		...
+	def close(self) -> None:
+		"""
+		End the frame. The sink is left open.
+		"""
+		...
+
+class FrameDecompressor:
+	"""
+	Incrementally decompress an LZ4 frame fed to it in chunks of any size,
+	writing the result to a file-like sink.
+	The sink must be done with each buffer when its write returns.
+	"""
+	sink: _Sink
+	eof: bool
+	bytes_in: int
+	bytes_out: int
+	def __init__(self, sink: _Sink): ...
+	def __enter__(self) -> FrameDecompressor: ...
+	def __exit__(self, *exc) -> None: ...
+	def write(self, data: bytes|bytearray|memoryview) -> int: ...
+	def close(self) -> None:
+		"""
+		Check the whole frame was seen. The sink is left open.
+		"""
+		...
+
+def compress_stream(src: BinaryIO, dst: _Sink, compressionLevel: int, contentSize: int = 0) -> int:
+	"""
+	Compress everything read from src into a frame written to dst.
+	Returns the compressed size.
+	"""
+	...
+
+def decompress_stream(src: BinaryIO, dst: _Sink) -> int:
+	"""
+	Decompress a frame read from src into dst. Returns the decompressed size.
+	"""
+	...
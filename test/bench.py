@@ -0,0 +1,211 @@
+"""
+Benchmarks on synthetic pkgs. Prints throughput as JSON so runs from
+different versions can be compared:
+
+	python test/bench.py --entries 500 --max-size 1M -o before.json
+"""
+import argparse
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+test = Path(__file__).parent
+cwd = test.parent
+
+sys.path.append(str(cwd))
+from dividedpkg import PKG, get_key, xor_buffer, xor_parallel
+from dividedpkg.filters import parse_size
+
+# Repeated in compressible parts of the data
+FILLER = b"Indivisible asset data, quite repetitive. " * 16
+
+
+def make_data(rng: random.Random, size: int, compressibility: float):
+	"""
+	Bytes where about compressibility of each 4 KiB block is filler and the
+	rest random.
+	"""
+	out = bytearray()
+	while len(out) < size:
+		n = min(4096, size - len(out))
+		fill = int(n * compressibility)
+		out += (FILLER * (fill // len(FILLER) + 1))[:fill]
+		out += rng.randbytes(n - fill)
+	return bytes(out)
+
+
+def make_tree(root: Path, entries: int, min_size: int, max_size: int,
+	compressibility: float, compressed: float, seed: int,
+):
+	"""
+	Files with log-uniformly distributed sizes spread over a few folders.
+	Names ending in .c.bin are meant to be compressed in the pkg.
+	"""
+	rng = random.Random(seed)
+	total = 0
+	for i in range(entries):
+		size = int(min_size * (max_size / min_size) ** rng.random()) if max_size > min_size else min_size
+		ext = ".c.bin" if rng.random() < compressed else ".bin"
+		fp = root / f"d{i % 16}" / f"f{i}{ext}"
+		fp.parent.mkdir(parents=True, exist_ok=True)
+		fp.write_bytes(make_data(rng, size, compressibility))
+		total += size
+	return total
+
+
+def timed(func: Callable[[], object], repeat: int, setup: Callable[[], object]|None = None):
+	"""
+	Best time of repeat runs.
+	"""
+	best = float("inf")
+	for _ in range(repeat):
+		if setup:
+			setup()
+		start = time.perf_counter()
+		func()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+
+def result(seconds: float, nbytes: int, items: int = 1):
+	return {
+		"seconds": seconds,
+		"bytes": nbytes,
+		"items": items,
+		"mb_per_s": nbytes / seconds / 1e6 if seconds else None,
+		"items_per_s": items / seconds if seconds else None,
+	}
+
+
+def version():
+	try:
+		return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=cwd,
+			capture_output=True, encoding="utf8").stdout.strip() or None
+	except OSError:
+		return None
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark dividedpkg on synthetic pkgs")
+	parser.add_argument("--entries", type=int, default=200)
+	parser.add_argument("--min-size", type=parse_size, default=parse_size("1K"))
+	parser.add_argument("--max-size", type=parse_size, default=parse_size("256K"))
+	parser.add_argument("--compressibility", type=float, default=0.5,
+		help="Fraction of each file that's easily compressed (default 0.5)")
+	parser.add_argument("--compressed", type=float, default=0.5,
+		help="Fraction of entries stored compressed (default 0.5)")
+	parser.add_argument("--xor-size", type=parse_size, default=parse_size("64M"))
+	parser.add_argument("--jobs", "-j", type=int, default=0,
+		help="Workers for the parallel variants, 0 for one per CPU (default 0)")
+	parser.add_argument("--repeat", "-r", type=int, default=3)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--only", action="append",
+		help="Only run benchmarks whose name contains this (can be specified multiple times)")
+	parser.add_argument("--output", "-o", type=Path, help="Also write the results here")
+	args = parser.parse_args()
+
+	results = dict[str, dict]()
+	def bench(name: str, nbytes: int, func: Callable[[], object], items=1,
+		setup: Callable[[], object]|None = None,
+	):
+		if args.only and not any(x in name for x in args.only):
+			return
+		results[name] = result(timed(func, args.repeat, setup), nbytes, items)
+		print(f"{name:32s} {results[name]['mb_per_s'] or 0:10.1f} MB/s", file=sys.stderr)
+
+	with tempfile.TemporaryDirectory(prefix="dividedpkg-bench-") as tmp:
+		tmp = Path(tmp)
+		src = tmp / "src"
+		total = make_tree(src, args.entries, args.min_size, args.max_size,
+			args.compressibility, args.compressed, args.seed)
+
+		from lz4fwrapper import compress_frame, decompress_frame
+		sample = (src / "d0").glob("*")
+		sample_data = b"".join(x.read_bytes() for x in sample)
+		frame = compress_frame(sample_data, 12)
+		bench("compress_frame", len(sample_data), lambda: compress_frame(sample_data, 12))
+		bench("decompress_frame", len(sample_data), lambda: decompress_frame(frame))
+
+		key = get_key()
+		buf = bytearray(args.xor_size)
+		bench("xor_buffer", len(buf), lambda: xor_buffer(buf, key, 0))
+		bench("xor_parallel", len(buf), lambda: xor_parallel(buf, key, 0))
+		del buf
+
+		for encrypt in (True, False):
+			kind = "encrypted" if encrypt else "plain"
+			fp = tmp / f"{kind}.pkg"
+			def create(fp=fp, encrypt=encrypt, jobs=1):
+				pkg = PKG.create(src, encrypt=encrypt, compress_include=["*.c.bin"], jobs=jobs)
+				pkg.write(fp, src, jobs=jobs)
+			bench(f"create_write.{kind}", total, create, args.entries)
+			bench(f"create_write.{kind}.parallel", total,
+				lambda: create(jobs=args.jobs), args.entries)
+			if not fp.exists():
+				create()
+			size = fp.stat().st_size
+			count = len(PKG.load(fp).files)
+
+			bench(f"load.{kind}", size, lambda: PKG.load(fp), count)
+			pkg = PKG.load(fp)
+			bench(f"list.{kind}", size,
+				lambda: [(x.offset, x.size, x.name) for x in pkg.files.values()], count)
+			bench(f"select.{kind}", size,
+				lambda: pkg.select(["*.c.bin", "d1/*", "d2/*"], ["d2/f1*"]), count)
+			def read_all():
+				pkg = PKG.load(fp)
+				for fn in pkg.files:
+					pkg.read(fn)
+				pkg.close()
+			bench(f"read.{kind}", total, read_all, count)
+
+			out = tmp / "out"
+			def export(jobs: int):
+				pkg = PKG.load(fp)
+				pkg.export_all(out, jobs=jobs)
+				pkg.close()
+			clean = lambda: shutil.rmtree(out, ignore_errors=True)
+			bench(f"export_all.{kind}", total, lambda: export(1), count, setup=clean)
+			bench(f"export_all.{kind}.parallel", total, lambda: export(args.jobs), count,
+				setup=clean)
+			clean()
+
+			# Same size so it's patched in place
+			victim = pkg.files.names()[len(pkg.files) // 2]
+			imp = tmp / "import"
+			(imp / victim).parent.mkdir(parents=True, exist_ok=True)
+			(imp / victim).write_bytes(pkg.read(victim, decompress=False))
+			pkg.close()
+			work = tmp / "work.pkg"
+			def import1():
+				pkg = PKG.load(work)
+				# Only the entry itself, not saving what it overwrites
+				pkg.import1(victim, imp, prefer_compressed=True, backup=False)
+				pkg.close()
+			bench(f"import1.{kind}", pkg.files[victim].size, import1,
+				setup=lambda: shutil.copyfile(fp, work))
+
+	report = {
+		"version": version(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"xor": getattr(xor_buffer, "__module__", None),
+		"params": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+		"total_bytes": total,
+		"results": results,
+	}
+	text = json.dumps(report, indent="\t")
+	print(text)
+	if args.output:
+		args.output.write_text(text + "\n")
+
+
+if __name__ == "__main__":
+	main()
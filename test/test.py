@@ -1,4 +1,5 @@
 import os, sys
+import shutil
 import subprocess
 from pathlib import Path
 
@@ -15,6 +16,8 @@ env = os.environ.copy()
 try: del env["PYTHONHOME"]
 except: pass
 env["PATH"] = f"{venv}/Scripts:{env['PATH']}"
+# Never talk to (or replace) a server the user has running
+env["DIVIDEDPKG_SERVER_STATE"] = os.environ["DIVIDEDPKG_SERVER_STATE"] = str(test / "server.json")
 
 def run(*args: str):
 	return subprocess.run(
@@ -61,6 +64,46 @@ else:
 	b.write_bytes(b_bytes)
 	err("lz4 test failed")
 
+# Anything after the end of a frame is an error, streamed or not
+
+if (
+	run("-C", b).returncode == 0
+	and b_lz4.write_bytes(b_lz4.read_bytes() + b"junk")
+	and "Failed to decompress" in run("-U", b_lz4).stdout
+	and b_bytes == b.read_bytes()
+):
+	ok("lz4 trailing data test success")
+else:
+	err("lz4 trailing data test failed")
+b_lz4.unlink(missing_ok=True)
+b.with_suffix(".txt.tmp").unlink(missing_ok=True)
+
+# NumPy fallback gives the same bytes as the extension, across the key's end
+
+try:
+	import xorcrypt
+	from dividedpkg import get_key, xornumpy
+except ImportError:
+	print("xor fallback test skipped, needs the extension and NumPy", file=sys.stderr)
+else:
+	key = get_key()
+	data = os.urandom(len(key) + 5000)
+	same = True
+	for offset, size in ((0, 0), (3, 100), (len(key) - 7, 20), (len(key) - 100, len(key) + 300),
+		(5 * len(key) + 11, 4096),
+	):
+		x, y = bytearray(data[:size]), bytearray(data[:size])
+		xorcrypt.xor_buffer(x, key, offset)
+		xornumpy.xor_buffer(y, key, offset)
+		same = same and x == y
+		xorcrypt.rekey_buffer(x, key, offset, offset + 12345)
+		xornumpy.rekey_buffer(y, key, offset, offset + 12345)
+		same = same and x == y
+	if same:
+		ok("xor fallback test success")
+	else:
+		err("xor fallback test failed")
+
 # Create new pkg with compression
 pkg = test / "contents.pkg"
 if (
@@ -116,6 +159,32 @@ else:
 	err("unpack pkg test skipped")
 
 
+# Create with the compression cache, twice, should match
+
+cache = test / "cache"
+if (
+	run("-p", "-c", "*.compressme.*", "--cache-dir", cache, contents, pkg).returncode == 0
+	and (pkg_bytes := pkg.read_bytes())
+	and len(list(cache.glob("*/*.lz4"))) == 1
+	and run("-p", "-c", "*.compressme.*", "--cache-dir", cache, contents, pkg).returncode == 0
+	and pkg.read_bytes() == pkg_bytes
+	# Imports go through the cache too
+	and shutil.copytree(contents, imp := test / "cached", dirs_exist_ok=True)
+	and (imp / b_id).write_bytes(b_bytes * 2)
+	and run("-p", "--cache-dir", cache, imp / b_id, pkg).returncode == 0
+	and len(list(cache.glob("*/*.lz4"))) == 2
+	and PKG.load(pkg).read(b_id + ".lz4") == b_bytes * 2
+):
+	ok("create pkg with cache test success")
+else:
+	err("create pkg with cache test failed")
+pkg.unlink(missing_ok=True)
+pkg.with_stem(pkg.stem + ".bak").unlink(missing_ok=True)
+pkg.with_name(pkg.name + ".undo").unlink(missing_ok=True)
+shutil.rmtree(cache, ignore_errors=True)
+shutil.rmtree(test / "cached", ignore_errors=True)
+
+
 # Create new package only specifying folder
 
 if (
@@ -127,7 +196,506 @@ if (
 else:
 	err("create pkg from folder only test failed")
 
-# TODO: include1 path
+# Import into an existing pkg, in place then with a size change
+
+imp = test / "import"
+shutil.copytree(contents, imp, dirs_exist_ok=True)
+if (
+	run("-p", "-c", "*.compressme.*", imp, pkg).returncode == 0
+	and (original := pkg.read_bytes())
+	and (imp / a_id).write_bytes(b"hello world!\n"[::-1])
+	and "in place" in run("-p", imp / a_id, pkg).stdout
+	# Only what was overwritten is kept, and can be put back
+	and not pkg.with_stem(pkg.stem + ".bak").exists()
+	and run("--undo", pkg).returncode == 0
+	and pkg.read_bytes() == original
+	# The last entry growing then shrinking again is put back too
+	and (imp / a_id).write_bytes(a_bytes * 20)
+	and "in place" in run("-p", imp / a_id, pkg).stdout
+	and len(pkg.read_bytes()) > len(original)
+	and (imp / a_id).write_bytes(a_bytes)
+	and "in place" in run("-p", imp / a_id, pkg).stdout
+	and run("--undo", pkg).returncode == 0
+	and pkg.read_bytes() == original
+	and (imp / a_id).write_bytes(a_bytes)
+	and "in place" in run("-p", imp / a_id, pkg).stdout
+	and PKG.load(pkg).read(a_id) == a_bytes
+	and (imp / a_id).write_bytes(b"goodbye world, hello pkg!\n")
+	and (imp / b_id).write_bytes(b_bytes * 3)
+	and run("-p", imp / a_id, imp / b_id, pkg).returncode == 0
+	and PKG.load(pkg).read(a_id) == (imp / a_id).read_bytes()
+	and PKG.load(pkg).read(b_id + ".lz4") == b_bytes * 3
+):
+	ok("import pkg test success")
+else:
+	err("import pkg test failed")
+pkg.unlink(missing_ok=True)
+pkg.with_stem(pkg.stem + ".bak").unlink(missing_ok=True)
+pkg.with_name(pkg.name + ".undo").unlink(missing_ok=True)
+shutil.rmtree(imp, ignore_errors=True)
+
+# List and unpack several pkgs in separate processes
+
+pkg2 = pkg.with_stem("contents2")
+out = test / "out"
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and shutil.copyfile(pkg, pkg2)
+	and (p := run("-l", "-j", 2, pkg, pkg2)).returncode == 0
+	and [x for x in p.stdout.splitlines() if x.startswith("#")] == [f"# {pkg}:", f"# {pkg2}:"]
+	and run("-u", "-j", 2, pkg.relative_to(cwd), pkg2.relative_to(cwd),
+		out.mkdir(exist_ok=True) or out).returncode == 0
+	# Folders are named after the pkg paths
+	and (out / "test" / pkg.stem / a_id).read_bytes() == a_bytes
+	and (out / "test" / pkg2.stem / b_id).read_bytes() == b_bytes
+):
+	ok("multiple pkgs test success")
+else:
+	err("multiple pkgs test failed")
+pkg.unlink(missing_ok=True)
+pkg2.unlink(missing_ok=True)
+shutil.rmtree(out, ignore_errors=True)
+
+# Unpack one pkg with several workers, then again over what's there
+
+out = test / "out"
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and run("-u", "-j", 0, pkg, out).returncode == 0
+	and (out / a_id).read_bytes() == a_bytes
+	and (out / b_id).read_bytes() == b_bytes
+	and (out / a_id).write_bytes(b"changed\n")
+	and PKG.load(pkg).export_all(out, jobs=2) == 2
+	# Only the changed file is backed up
+	and (out / a_id).read_bytes() == a_bytes
+	and (out / "a.bak.txt").read_bytes() == b"changed\n"
+	and not (out / "b.compressme.bak.txt").exists()
+	and (out / b_id).read_bytes() == b_bytes
+):
+	ok("parallel unpack test success")
+else:
+	err("parallel unpack test failed")
+pkg.unlink(missing_ok=True)
+shutil.rmtree(out, ignore_errors=True)
+
+# Async reads of the same entry are shared, and export matches export_all
+
+import asyncio, gc, time
+from dividedpkg.aio import AsyncPKG
+out2 = test / "out2"
+unretrieved = list[dict]()
+async def async_test():
+	asyncio.get_running_loop().set_exception_handler(lambda _, ctx: unretrieved.append(ctx))
+	async with await AsyncPKG.load(pkg) as apkg:
+		reads = list[str]()
+		read = apkg.pkg.read
+		def counted(fn: str, decompress=True):
+			reads.append(fn)
+			if fn == a_id and not decompress:
+				raise RuntimeError("failed read")
+			if not decompress:
+				time.sleep(0.2)
+			return read(fn, decompress)
+		apkg.pkg.read = counted
+		names = [a_id, b_id + ".lz4"] * 3
+		first, second = await asyncio.gather(apkg.read_many(names), apkg.read_many(names[::-1]))
+		coalesced = sorted(reads) == [a_id, b_id + ".lz4"]
+		try:
+			await apkg.read_many([b_id + ".lz4", a_id, b_id + ".lz4"], decompress=False)
+			failed = False
+		except RuntimeError:
+			# Only once the other reads are done too
+			failed = not apkg._reads
+		apkg.pkg.read = read
+		await asyncio.gather(*(apkg.export(fn, out2) for fn in apkg.files.keys()))
+		gc.collect()
+		await asyncio.sleep(0)
+	return (first == second[::-1] == [a_bytes, b_bytes] * 3
+		and coalesced and failed)
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and asyncio.run(async_test())
+	and not unretrieved
+	and PKG.load(pkg).export_all(out, jobs=2) == 2
+	and all((out2 / fn).read_bytes() == (out / fn).read_bytes() for fn in (a_id, b_id))
+	and sorted(x.name for x in out2.iterdir()) == sorted(x.name for x in out.iterdir())
+):
+	ok("async pkg test success")
+else:
+	err("async pkg test failed")
+pkg.unlink(missing_ok=True)
+shutil.rmtree(out, ignore_errors=True)
+shutil.rmtree(out2, ignore_errors=True)
+
+# A folder of pkgs, where the later pkg in number order wins a shared name
+
+from dividedpkg.filters import Filter
+from dividedpkg.pkgset import PKGSet
+pkgs_dir = test / "pkgset"
+newer = test / "pkgset_src"
+(newer / "sub").mkdir(parents=True, exist_ok=True)
+(newer / a_id).write_bytes(b"newer a\n")
+(newer / "sub" / "c.txt").write_bytes(b"only in the newer pkg\n")
+pkgs_dir.mkdir(exist_ok=True)
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkgs_dir / "data_2.pkg").returncode == 0
+	and run("-p", newer, pkgs_dir / "data_10.pkg").returncode == 0
+	and (p := run("-l", pkgs_dir)).returncode == 0
+	and p.stdout.splitlines()[1:] == [
+		f"{'data_10.pkg':16s}, 0x{8:08x}, {a_id}",
+		f"{'data_2.pkg':16s}, 0x{PKG.load(pkgs_dir / 'data_2.pkg').files[b_id + '.lz4'].size:08x}, {b_id}.lz4",
+		f"{'data_10.pkg':16s}, 0x{22:08x}, sub/c.txt",
+	]
+):
+	with PKGSet.load(pkgs_dir) as pkgs:
+		newest = PKG.load(pkgs_dir / "data_10.pkg")
+		if (
+			pkgs.read(a_id) == b"newer a\n"
+			and pkgs.read(b_id + ".lz4") == b_bytes
+			and [x.filename.name for x in pkgs.providers(a_id)] == ["data_2.pkg", "data_10.pkg"]
+			# Globs as select has them, * staying within a part
+			and pkgs.glob("c.txt") == ["sub/c.txt"] == newest.select(filter=Filter(["c.txt"]))
+			and pkgs.glob("s*.txt") == [] == newest.select(filter=Filter(["s*.txt"]))
+			and pkgs.glob("*.txt") == [a_id, "sub/c.txt"]
+		):
+			ok("pkg set test success")
+		else:
+			err("pkg set test failed")
+		newest.close()
+else:
+	err("pkg set test failed")
+shutil.rmtree(pkgs_dir, ignore_errors=True)
+shutil.rmtree(newer, ignore_errors=True)
+
+# Per-stage totals of an unpack, from loading the table to writing files
+
+out = test / "out"
+def stage_counts(stderr: str):
+	lines = stderr.splitlines()
+	start = lines.index(next(x for x in lines if x.startswith("stage")))
+	return {x.split()[0]: int(x.split()[1]) for x in lines[start + 1:] if not x.startswith("total")}
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and (p := run("-u", "--stats", pkg, out)).returncode == 0
+	and (out / b_id).read_bytes() == b_bytes
+	and stage_counts(p.stderr) == {"load": 1, "read": 2, "xor": 2, "decompress": 1, "write": 2}
+	and "total" in p.stderr.splitlines()[-1]
+):
+	ok("stats test success")
+else:
+	err("stats test failed")
+pkg.unlink(missing_ok=True)
+shutil.rmtree(out, ignore_errors=True)
+
+# The in-memory entry cache drops the least recently used past its limit
+
+from dividedpkg.cache import EntryCache
+cache = EntryCache(10)
+cache.put("a", b"aaaa")
+cache.put("b", b"bbbb")
+cache.put("a", b"AAAA")
+hit = cache.get("a")
+cache.put("c", b"cc")
+cache.put("d", b"dd")
+cache.put("e", b"e" * 11)
+cache.put("c", b"c" * 11)
+if (
+	hit == b"AAAA"
+	# b was used longest ago, c got too big to keep, e never fit
+	and [cache.get(x) for x in "abcde"] == [b"AAAA", None, None, b"dd", None]
+	and cache.size == 6 and len(cache) == 2
+	and {k: cache.stats()[k] for k in ("hits", "misses", "evictions")}
+		== {"hits": 3, "misses": 3, "evictions": 1}
+):
+	ok("entry cache test success")
+else:
+	err("entry cache test failed")
+
+# Bad options are argparse errors, not tracebacks
+
+if all(
+	(p := run("-p", "--level-for", bad, contents, pkg)).returncode == 2
+	and "Traceback" not in p.stderr and "--level-for" in p.stderr
+	for bad in ("*.txt=bogus", "*.txt", "=3")
+) and run("-h").returncode == 0:
+	ok("bad options test success")
+else:
+	err("bad options test failed")
+pkg.unlink(missing_ok=True)
+
+# Load through the index, then with it damaged
+
+index_dir = test / "index_cache"
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and (listed := run("-l", pkg).stdout)
+	and run("-l", "--index", "--cache-dir", index_dir, pkg).stdout == listed
+	and (idx := next((index_dir / "index").glob("*.idx"), None))
+	and run("-l", "--index", "--cache-dir", index_dir, pkg).stdout == listed
+	and idx.write_bytes(idx.read_bytes()[:-3])
+	# Treated as a miss and written again
+	and run("-l", "--index", "--cache-dir", index_dir, pkg).stdout == listed
+	and run("-l", "--index", "--cache-dir", index_dir, pkg).stdout == listed
+):
+	ok("index test success")
+else:
+	err("index test failed")
+pkg.unlink(missing_ok=True)
+shutil.rmtree(index_dir, ignore_errors=True)
+
+# Build a pkg straight from memory
+
+from dividedpkg.writer import PKGWriter
+def writer_abort():
+	try:
+		with PKGWriter(pkg) as writer:
+			writer.add(a_id, b"partial")
+			raise RuntimeError("stopped")
+	except RuntimeError as e:
+		return e
+if (
+	PKGWriter.build(pkg, [(a_id, a_bytes, False), (b_id, b_bytes, True)]).files.names()
+		== [a_id, b_id + ".lz4"]
+	and (p := PKG.load(pkg)).encrypted
+	and p.read(a_id) == a_bytes
+	and p.read(b_id + ".lz4") == b_bytes
+	and (p.close() or True)
+	and (original := pkg.read_bytes())
+	# Failing part way puts back the pkg it was replacing
+	and isinstance(writer_abort(), RuntimeError)
+	and pkg.exists() and pkg.read_bytes() == original
+	and not pkg.with_stem(pkg.stem + ".bak").exists()
+):
+	ok("pkg writer test success")
+else:
+	err("pkg writer test failed")
+pkg.unlink(missing_ok=True)
+pkg.with_stem(pkg.stem + ".bak").unlink(missing_ok=True)
+
+# Write loaded pkgs to new files, copying their data as it's stored, with
+# the OS doing it, with sendfile and in Python, converting or not
+
+import dividedpkg
+big = bytes(range(256)) * (40 << 10)
+entries = {a_id: a_bytes, b_id + ".lz4": b_bytes, "big.bin": big}
+copy2 = pkg.with_stem("copy")
+def copied(encrypt: bool, to: bool|None):
+	PKGWriter.build(pkg, [(a_id, a_bytes, False), (b_id, b_bytes, True), ("big.bin", big, False)],
+		encrypt=encrypt)
+	src = PKG.load(pkg)
+	src.write(copy2, encrypt=to)
+	src.close()
+	with PKG.load(copy2) as out:
+		return (out.encrypted == (encrypt if to is None else to)
+			and all(out.read(k) == v for k, v in entries.items()))
+copy_file_range = getattr(os, "copy_file_range", None)
+copy_range = dividedpkg.copy_range
+results = list[bool]()
+try:
+	for mode in ("os", "sendfile", "python"):
+		if mode == "sendfile" and copy_file_range:
+			del os.copy_file_range
+		elif mode == "python":
+			dividedpkg.copy_range = lambda *_: False
+		results += [copied(*x) for x in ((True, None), (False, None), (True, False), (False, True))]
+finally:
+	if copy_file_range:
+		os.copy_file_range = copy_file_range
+	dividedpkg.copy_range = copy_range
+if all(results) and len(results) == 12:
+	ok("copy pkg test success")
+else:
+	err(f"copy pkg test failed: {results}")
+for x in (pkg, copy2):
+	x.unlink(missing_ok=True)
+	x.with_stem(x.stem + ".bak").unlink(missing_ok=True)
+
+# Random reads through PKG.open match reading the whole entry
+
+import random
+from io import BytesIO
+from lz4fwrapper import FrameCompressor, compress_frame, compress_stream
+from dividedpkg.policy import STORE_LEVEL
+
+rng = random.Random(16)
+big = (os.urandom(1000) * 9500)[:9 << 20]
+flushed = BytesIO()
+with FrameCompressor(flushed, 1, len(big)) as comp:
+	# A short block where the content size says they're all full
+	comp.write(big[:1 << 20])
+	comp.flush()
+	comp.write(big[1 << 20:])
+streamed = BytesIO()
+compress_stream(BytesIO(big[:5 << 20]), streamed, 1)
+stored = os.urandom(300 << 10)
+expected = {
+	# Several 4 MB blocks
+	"big.bin.lz4": (compress_frame(big, 1), big),
+	"stored.bin.lz4": (compress_frame(stored, STORE_LEVEL), stored),
+	# No content size
+	"streamed.bin.lz4": (streamed.getvalue(), big[:5 << 20]),
+	"flushed.bin.lz4": (flushed.getvalue(), big),
+	"empty.bin.lz4": (b"", b""),
+	"empty_frame.bin.lz4": (compress_frame(b"", 1), b""),
+}
+PKGWriter.build(pkg, [(name, frame, False) for name, (frame, _) in expected.items()])
+good = True
+with PKG.load(pkg) as p:
+	for name, (_, data) in expected.items():
+		good = good and p.read(name) == data
+		# A few times over, so the first read after indexing isn't always the same
+		for _ in range(4):
+			with p.open(name) as f:
+				for _ in range(10):
+					pos = rng.randrange(len(data) + 10)
+					size = rng.choice((1, 100, 70000, 5 << 20))
+					f.seek(pos)
+					good = good and f.read(size) == data[pos:pos + size]
+				good = good and f.seek(0, os.SEEK_END) == len(data)
+				f.seek(-min(len(data), 10), os.SEEK_END)
+				good = good and f.read() == data[-10:]
+if good:
+	ok("entry reader test success")
+else:
+	err("entry reader test failed")
+pkg.unlink(missing_ok=True)
+del big, flushed, streamed, stored, expected
+
+# Patch one version of a pkg into another
+
+new = pkg.with_stem("contents_new")
+patch = test / "contents.patch"
+out_pkg = pkg.with_stem("contents_patched")
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and PKGWriter.build(new, [(a_id, b"patched\n", False), (b_id, b_bytes, True)])
+	# Only the changed file goes in the patch
+	and "1 changed file(s), 1 taken" in run("-D", pkg, new, patch).stdout
+	and run("-A", pkg, patch, out_pkg).returncode == 0
+	and out_pkg.read_bytes() == new.read_bytes()
+):
+	ok("patch pkg test success")
+else:
+	err("patch pkg test failed")
+for fp in (pkg, new, patch, out_pkg):
+	fp.unlink(missing_ok=True)
+
+# Filter by extension and size
+
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and (p := run("-l", "--ext", "txt", "--max-size", "32", pkg)).returncode == 0
+	and [x.split(", ")[-1] for x in p.stdout.splitlines()[1:]] == [a_id]
+	and [x.split(", ")[-1] for x in run("-l", "-i", "*.lz4", pkg).stdout.splitlines()[1:]]
+		== [b_id + ".lz4"]
+):
+	ok("filter test success")
+else:
+	err("filter test failed")
+pkg.unlink(missing_ok=True)
+
+# Verify a pkg, then damage a compressed entry
+
+if (
+	run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+	and run("-V", pkg).returncode == 0
+):
+	entry = PKG.load(pkg).files[b_id + ".lz4"]
+	damaged = bytearray(pkg.read_bytes())
+	# Last byte of the frame is part of its content checksum
+	damaged[entry.offset + entry.size - 1] ^= 1
+	pkg.write_bytes(damaged)
+	if (p := run("-V", pkg)).returncode == 1 and b_id in p.stdout:
+		ok("verify pkg test success")
+	else:
+		err("verify pkg test failed")
+else:
+	err("verify pkg test failed")
+pkg.unlink(missing_ok=True)
+
+# List and unpack through a running server
+
+server = subprocess.Popen(
+	["./venv/Scripts/python.exe", "-m", "dividedpkg", "--serve"],
+	cwd=cwd, env=env, encoding="utf8", stdout=subprocess.PIPE,
+)
+out_dir = test / "served"
+pkg2 = pkg.with_stem("contents2")
+try:
+	import json
+	from dividedpkg.server import Client
+	def served():
+		# How many pkgs the server has loaded, so only forwarded commands count
+		return json.loads(client.request("/ping"))["pkgs"]
+	if (
+		server.stdout.readline().startswith("Serving on")
+		and run("-p", "-c", "*.compressme.*", contents, pkg).returncode == 0
+		and shutil.copyfile(pkg, pkg2)
+		and (client := Client.connect())
+		and run("-l", "--no-server", pkg).returncode == 0
+		and served() == 0
+		and run("-l", pkg).stdout == run("-l", "--no-server", pkg).stdout
+		and served() == 1
+		and run("-u", pkg2, out_dir).returncode == 0
+		and served() == 2
+		and (out_dir / a_id).read_bytes() == a_bytes
+		and (out_dir / b_id).read_bytes() == b_bytes
+	):
+		ok("server test success")
+	else:
+		err("server test failed")
+finally:
+	try:
+		Client.connect().shutdown()
+	except AttributeError:
+		pass
+	server.wait(10)
+pkg.unlink(missing_ok=True)
+pkg2.unlink(missing_ok=True)
+shutil.rmtree(out_dir, ignore_errors=True)
+
+# Pack with reads and compression ahead of the writer, showing progress
+
+out_dir = test / "pipelined"
+if (
+	(p := run("-p", "-j", "0", "--progress", "-c", "*.compressme.*", contents, pkg)).returncode == 0
+	and "2/2 files" in p.stderr
+	and run("-u", "--no-server", pkg, out_dir).returncode == 0
+	and (out_dir / a_id).read_bytes() == a_bytes
+	and (out_dir / b_id).read_bytes() == b_bytes
+):
+	ok("pipelined pack test success")
+else:
+	err("pipelined pack test failed")
+pkg.unlink(missing_ok=True)
+shutil.rmtree(out_dir, ignore_errors=True)
+
+# Scan lists nested folders, but a dangling symlink is an error, not skipped
+
+from dividedpkg.pipeline import scan
+scanned = test / "scanned"
+(scanned / "sub").mkdir(parents=True, exist_ok=True)
+shutil.copy(a, scanned / a_id)
+shutil.copy(b, scanned / "sub" / b_id)
+listed = sorted(p.relative_to(scanned).as_posix() for p, _ in scan(scanned, 2))
+(scanned / "dangling").symlink_to(scanned / "missing")
+try:
+	list(scan(scanned))
+	dangling_failed = False
+except FileNotFoundError:
+	dangling_failed = True
+if (
+	listed == [a_id, f"sub/{b_id}"]
+	and dangling_failed
+	and run("-p", scanned, pkg).returncode != 0
+	and not pkg.exists()
+):
+	ok("scan test success")
+else:
+	err("scan test failed")
+pkg.unlink(missing_ok=True)
+shutil.rmtree(scanned, ignore_errors=True)
+
 # TODO: encrypt/decrypt paths as well as in combination with
 
 print(f"Success: {success} / {success+fails}")
@@ -1,5 +1,30 @@
-def xor_buffer(data: bytearray, key: bytes, key_offset: int):
+PARALLEL_MIN: int
+BLOCK_SIZE: int
+
+def tiled_key(key: bytes) -> bytes:
+	...
+
+def xor_buffer(data: bytearray|memoryview, key: bytes, key_offset: int):
+	"""
+	XOR data in place with the key starting at key_offset, on this thread.
+	"""
+	...
+
+def xor_parallel(data: bytearray|memoryview, key: bytes, key_offset: int):
+	"""
+	Same as xor_buffer but large buffers are split across threads.
+	"""
+	...
+
+def rekey_buffer(data: bytearray|memoryview, key: bytes, old_offset: int, new_offset: int):
+	"""
+	Turn data encrypted for old_offset into data encrypted for new_offset,
+	in one pass, on this thread.
+	"""
 	...
 
-def xor_parallel(data: bytearray, key: bytes, key_offset: int):
+def rekey_parallel(data: bytearray|memoryview, key: bytes, old_offset: int, new_offset: int):
+	"""
+	Same as rekey_buffer but large buffers are split across threads.
+	"""
 	...